@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Admin socket for changing settings and managing connections at runtime,
+enabled with --admin. Uses the same protocol as the client API.
+"""
+import logging
+import time
+
+import admission
+from api import RequestHandler, UnixSocketServer
+from listener import Listener
+import ratelimit
+import registry
+import shared
+
+# Settings which can be changed at runtime: type and minimum value
+TUNABLES = {
+    'outgoing_connections': (int, 0),
+    'connection_limit': (int, 0),
+    'accept_rate': (int, 1),
+    'max_connections_per_ip': (int, 1),
+    'max_connections_per_subnet': (int, 1),
+    'rotation_interval': (int, 1),
+    'rotation_min_age': (int, 0),
+    'upload_limit': (int, 0),
+    'download_limit': (int, 0),
+    'peer_upload_limit': (int, 0),
+    'peer_download_limit': (int, 0),
+    'send_buffer_size': (int, 1024),
+    'request_window_min': (int, 1),
+    'request_window_max': (int, 1),
+    'max_getdata_batch': (int, 1),
+    'request_timeout_min': (float, 0),
+    'request_timeout_max': (float, 1),
+    'inv_chunk_size': (int, 1),
+    'select_timeout': (float, 0.001),
+    'advertise_interval': (float, 0.01),
+    'request_check_interval': (float, 0.01),
+    'sketch_cells': (int, 1),
+    'send_budget': (int, 0),
+    'memory_limit': (int, 0),
+    'send_backlog_limit': (int, 0),
+    'max_vectors_to_get': (int, 0),
+    'max_vectors_to_send': (int, 0),
+    'timeout': (int, 30),
+    'overload_lag': (float, 0.001),
+    'overload_validation_load': (float, 0.01),
+    'overload_getdata_batch': (int, 0),
+    'min_useful_ratio': (float, 0),
+}
+
+# Pairs of settings where the first one must not be greater than the second one
+BOUNDS = (
+    ('outgoing_connections', 'connection_limit'),
+    ('max_connections_per_ip', 'max_connections_per_subnet'),
+    ('request_window_min', 'request_window_max'),
+    ('request_timeout_min', 'request_timeout_max'),
+)
+
+# Jobs of the Manager which can be run on request
+JOBS = ('clean_objects', 'pickle_objects', 'pickle_nodes', 'manage_memory', 'rotate_outgoing')
+
+
+def _apply(name, value):
+    """Updates objects created from the setting"""
+    if name == 'accept_rate':
+        Listener.accept_bucket.set_rate(value, 2 * value)
+    elif name == 'upload_limit':
+        ratelimit.upload.set_rate(value)
+    elif name == 'download_limit':
+        ratelimit.download.set_rate(value)
+    elif name == 'peer_upload_limit':
+        for c in shared.connections:
+            c.upload_bucket.set_rate(value)
+    elif name == 'peer_download_limit':
+        for c in shared.connections:
+            c.download_bucket.set_rate(value)
+
+
+def _host(request):
+    host = request['host']
+    return host.encode() if request.get('network') == 'i2p' else host
+
+
+class AdminHandler(RequestHandler):
+    # Set by AdminServer
+    scheduler = None
+
+    def _command_get(self, request):
+        names = request.get('settings') or sorted(TUNABLES)
+        return {'settings': {name: getattr(shared, name) for name in names if name in TUNABLES}}
+
+    def _command_set(self, request):
+        """All settings are checked before any of them is changed"""
+        settings = {}
+        for name, value in request['settings'].items():
+            if name not in TUNABLES:
+                raise KeyError('unknown setting {}'.format(name))
+            kind, minimum = TUNABLES[name]
+            if type(value) not in (int, float) or (kind == int and type(value) != int):
+                raise TypeError('{} must be {}'.format(name, kind.__name__))
+            if value < minimum:
+                raise ValueError('{} must be at least {}'.format(name, minimum))
+            settings[name] = kind(value)
+        for low, high in BOUNDS:
+            if settings.get(low, getattr(shared, low)) > settings.get(high, getattr(shared, high)):
+                raise ValueError('{} must not be greater than {}'.format(low, high))
+        for name, value in settings.items():
+            logging.info('Setting {} changed from {} to {}'.format(name, getattr(shared, name), value))
+            setattr(shared, name, value)
+            _apply(name, value)
+        return self._command_get({'settings': list(settings)})
+
+    def _command_connections(self, request):
+        result = []
+        for c in shared.connections.select(request.get('status'), request.get('network')):
+            info = {
+                'host': str(c.host_print), 'port': str(c.port), 'network': c.network, 'server': c.server,
+                'status': c.status, 'age': round(time.time() - c.start_time),
+                'send_queue': c.send_queue.qsize(),
+            }
+            info.update(c.stats())
+            result.append(info)
+        return {'connections': result}
+
+    def _command_disconnect(self, request):
+        host = registry.normal_host(_host(request))
+        port = request.get('port')
+        disconnected = 0
+        for c in shared.connections:
+            if registry.normal_host(c.host) == host and (port is None or str(c.port) == str(port)):
+                c.status = 'disconnecting'
+                disconnected += 1
+        return {'disconnected': disconnected}
+
+    def _command_ban(self, request):
+        """Disconnects the host and refuses connections to and from it for `seconds`"""
+        host = _host(request)
+        seconds = request.get('seconds', 24 * 3600)
+        connections = shared.connections.ban(host, seconds)
+        for c in connections:
+            c.status = 'disconnecting'
+        logging.info('Banned {} for {} seconds'.format(request['host'], seconds))
+        return {'banned': request['host'], 'disconnected': len(connections)}
+
+    def _command_unban(self, request):
+        return {'unbanned': shared.connections.unban(_host(request))}
+
+    def _command_bans(self, request):
+        now = time.time()
+        return {'bans': {(h.decode() if isinstance(h, bytes) else h): round(until - now)
+                         for h, until in shared.connections.banned.copy().items() if until > now}}
+
+    def _command_run(self, request):
+        """Runs a maintenance job of the Manager as soon as possible"""
+        job = request['job']
+        if job not in JOBS:
+            raise ValueError('job must be one of {}'.format(', '.join(JOBS)))
+        self.scheduler.run_soon(job)
+        return {'scheduled': job}
+
+    def _command_jobs(self, request):
+        return {'jobs': self.scheduler.stats()}
+
+    def _command_stats(self, request):
+        return {'listener': Listener.stats(), 'admission': admission.control.stats(), 'tombstones': shared.tombstones.stats(),
+                'objects': len(shared.objects), 'connections': len(shared.connections),
+                'memory_pressure': shared.memory_pressure}
+
+
+class AdminServer(UnixSocketServer):
+    """Admin socket, see README"""
+    handler_class = AdminHandler
+
+    def __init__(self, path, scheduler):
+        super().__init__(path, 'Admin Server')
+        AdminHandler.scheduler = scheduler
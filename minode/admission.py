@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control. The monitor measures how late it wakes up, which grows
+when connection threads fight for the GIL, and the share of time spent
+validating objects. While either is over its limit the node is overloaded:
+connections request fewer objects, inv messages from peers which rarely
+send new objects are put aside and incoming connections are refused.
+Control messages such as ping and pong are never held back.
+"""
+import logging
+import threading
+import time
+
+import ratelimit
+import shared
+
+
+class AdmissionControl(object):
+    def __init__(self):
+        # Smoothed loop lag in seconds
+        self.lag = 0.0
+        # Seconds spent validating objects per second
+        self.validation = ratelimit.RateMeter(period=5)
+        self.overloaded = False
+        self.overload_start = None
+        self.overloads = 0
+        self.overload_seconds = 0.0
+
+    def __repr__(self):
+        return 'admission_control, lag: {:.3f}, validation_load: {:.2f}, overloaded: {}'.format(
+            self.lag, self.validation.rate(), self.overloaded)
+
+    def validated(self, seconds):
+        self.validation.add(seconds)
+
+    def update(self, lag):
+        self.lag = 0.8 * self.lag + 0.2 * lag
+        load = self.validation.rate()
+        if not self.overloaded:
+            if self.lag > shared.overload_lag or load > shared.overload_validation_load:
+                self.overloaded = True
+                self.overload_start = time.time()
+                self.overloads += 1
+                logging.warning('Overloaded, loop lag: {:.3f} s, validation load: {:.2f}, shedding load'.format(
+                    self.lag, load))
+        elif self.lag < shared.overload_lag / 2 and load < shared.overload_validation_load / 2:
+            self.overloaded = False
+            duration = time.time() - self.overload_start
+            self.overload_seconds += duration
+            logging.info('Load back to normal after {:.1f} seconds'.format(duration))
+
+    def stats(self):
+        return {
+            'overloaded': self.overloaded,
+            'lag': round(self.lag, 4),
+            'validation_load': round(self.validation.rate(), 3),
+            'overloads': self.overloads,
+            'overload_seconds': round(self.overload_seconds, 1),
+        }
+
+
+control = AdmissionControl()
+
+
+def overloaded():
+    return shared.admission_control and control.overloaded
+
+
+class Monitor(threading.Thread):
+    """Measures loop lag as the delay of its own wake-ups"""
+    interval = 0.1
+
+    def __init__(self):
+        super().__init__(name='Admission monitor', daemon=True)
+
+    def run(self):
+        expected = time.monotonic() + self.interval
+        while not shared.shutdown_event.wait(self.interval):
+            now = time.monotonic()
+            control.update(max(now - expected, 0))
+            expected = now + self.interval
@@ -12,7 +12,7 @@ class Advertiser(threading.Thread):
 
     def run(self):
         while True:
-            time.sleep(0.4)
+            time.sleep(shared.advertise_interval)
             if shared.shutting_down:
                 logging.debug('Shutting down Advertiser')
                 break
@@ -25,9 +25,11 @@ class Advertiser(threading.Thread):
         while not shared.vector_advertise_queue.empty():
             vectors_to_advertise.add(shared.vector_advertise_queue.get())
         if len(vectors_to_advertise) > 0:
-            for c in shared.connections.copy():
-                if c.status == 'fully_established':
-                    c.send_queue.put(message.Inv(vectors_to_advertise))
+            inv = message.FramedMessage.encode(message.Inv(vectors_to_advertise))
+            if shared.trace_enabled:
+                inv.vectors = vectors_to_advertise
+            for c in shared.connections.select('fully_established'):
+                c.send_queue.put(inv)
 
     @staticmethod
     def _advertise_addresses():
@@ -39,6 +41,6 @@ class Advertiser(threading.Thread):
                 continue
             addresses_to_advertise.add(addr)
         if len(addresses_to_advertise) > 0:
-            for c in shared.connections.copy():
-                if c.status == 'fully_established':
-                    c.send_queue.put(message.Addr(addresses_to_advertise))
+            addr = message.FramedMessage.encode(message.Addr(addresses_to_advertise))
+            for c in shared.connections.select('fully_established'):
+                c.send_queue.put(addr)
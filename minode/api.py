@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+
+import pow
+import profiler
+import shared
+import structure
+import workers
+
+
+def _tag(obj):
+    """Tag of getpubkey and pubkey v4 and broadcast v5 objects, None for all others"""
+    if (obj.object_type in (0, 1) and obj.version >= 4) or (obj.object_type == 3 and obj.version >= 5):
+        return obj.object_payload[:32]
+    return None
+
+
+class UnixSocketServer(threading.Thread):
+    """Accepts local connections on a Unix socket and serves each one with handler_class"""
+    handler_class = None
+
+    def __init__(self, path, name):
+        super().__init__(name=name)
+        self.path = path
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.s.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.s.listen(16)
+        self.s.settimeout(1)
+
+    def run(self):
+        while not shared.shutting_down:
+            try:
+                conn, addr = self.s.accept()
+                self.handler_class(conn).start()
+            except socket.timeout:
+                pass
+        self.s.close()
+        os.remove(self.path)
+        logging.debug('Shutting down {}'.format(self.name))
+
+
+class RequestHandler(threading.Thread):
+    """Reads one JSON request per line and calls the matching _command_<name> method"""
+    def __init__(self, s):
+        super().__init__(name='{} client'.format(type(self).__name__), daemon=True)
+        self.s = s
+        self.s.settimeout(1)
+        self.buffer = b''
+
+    def run(self):
+        try:
+            while not shared.shutting_down:
+                try:
+                    data = self.s.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                self.buffer += data
+                while b'\n' in self.buffer:
+                    line, self.buffer = self.buffer.split(b'\n', 1)
+                    if line.strip():
+                        response = self._handle(line)
+                        if response is not None:
+                            self._send(response)
+        except OSError as e:
+            logging.debug('{} client disconnected: {}'.format(type(self).__name__, e))
+        finally:
+            self.s.close()
+
+    def _handle(self, line):
+        try:
+            request = json.loads(line.decode())
+            if not isinstance(request, dict):
+                return {'error': 'request must be a JSON object'}
+            command = getattr(self, '_command_' + request.get('command', ''), None)
+            if command is None:
+                return {'error': 'unknown command'}
+            return command(request)
+        except (ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    def _send(self, response):
+        self.s.sendall(json.dumps(response).encode() + b'\n')
+
+    def _closed(self):
+        r, _, _ = select.select([self.s], [], [], 0)
+        return bool(r) and not self.s.recv(1, socket.MSG_PEEK)
+
+
+class APIHandler(RequestHandler):
+    def _command_submit(self, request):
+        """Already PoW'd objects"""
+        accepted = []
+        rejected = []
+        for i, data in enumerate(request['objects']):
+            try:
+                obj = structure.Object.from_bytes(base64.b64decode(data))
+            except (ValueError, IndexError, struct.error):
+                # Not base64 (binascii.Error is a ValueError) or too short
+                rejected.append(i)
+                continue
+            if not obj.is_valid():
+                rejected.append(i)
+                continue
+            if obj.vector not in shared.objects:
+                with shared.objects_lock:
+                    shared.objects[obj.vector] = obj
+                workers.share_object(obj)
+                try:
+                    shared.vector_advertise_queue.put_nowait(obj.vector)
+                except queue.Full:
+                    logging.warning('Vector advertise queue is full, not advertising {}'.format(obj))
+            accepted.append(base64.b16encode(obj.vector).decode())
+        return {'accepted': accepted, 'rejected': rejected}
+
+    def _command_submit_pow(self, request):
+        """Objects without nonce, PoW is done by this node"""
+        objects = [structure.Object.from_bytes(b'\x00' * 8 + base64.b64decode(data)) for data in request['objects']]
+        for obj in objects:
+            if obj.is_expired() or obj.expires_time > time.time() + 28 * 24 * 3600 \
+                    or len(obj.object_payload) > 2**18 or obj.stream_number != shared.stream:
+                raise ValueError('object can not be published')
+        for obj in objects:
+            pow.do_pow_and_publish(obj)
+        return {'queued': len(objects)}
+
+    def _command_get(self, request):
+        objects = {}
+        for v in request['vectors']:
+            obj = shared.objects.get(base64.b16decode(v.upper()))
+            if obj:
+                objects[v] = base64.b64encode(obj.to_bytes()).decode()
+        return {'objects': objects}
+
+    def _command_list(self, request):
+        vectors = shared.objects.filter(
+            request.get('object_type'), request.get('expires_after'), request.get('expires_before'))
+        return {'vectors': [base64.b16encode(v).decode() for v in vectors]}
+
+    def _command_profile(self, request):
+        """Profiles all threads for `seconds`, the folded stacks are saved to `file`"""
+        path = profiler.Profiler.start_profile(request.get('seconds'))
+        if path is None:
+            return {'error': 'profiler is already running'}
+        return {'file': path}
+
+    def _command_lock_stats(self, request):
+        return {'locks': profiler.lock_stats()}
+
+    def _command_subscribe(self, request):
+        object_type = request.get('object_type')
+        tag_prefix = base64.b16decode(request.get('tag_prefix', '').upper())
+        q = queue.Queue(maxsize=10000)
+
+        def listener(obj):
+            if object_type is not None and obj.object_type != object_type:
+                return
+            if tag_prefix and not (_tag(obj) or b'').startswith(tag_prefix):
+                return
+            try:
+                q.put_nowait(obj)
+            except queue.Full:
+                pass
+
+        self._send({'subscribed': True})
+        shared.objects.listeners.append(listener)
+        try:
+            while not shared.shutting_down:
+                try:
+                    obj = q.get(timeout=1)
+                except queue.Empty:
+                    if self._closed():
+                        break
+                    continue
+                self._send({'vector': base64.b16encode(obj.vector).decode(),
+                            'object': base64.b64encode(obj.to_bytes()).decode()})
+        finally:
+            shared.objects.listeners.remove(listener)
+
+
+class APIServer(UnixSocketServer):
+    """Local client API, see README"""
+    handler_class = APIHandler
+
+    def __init__(self, path):
+        super().__init__(path, 'API Server')
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of MiNode internals, results are printed as JSON.
+
+    python3 benchmark.py vectors [--count 1000000]
+    python3 benchmark.py codec [--save FILE] [--baseline FILE]
+    python3 benchmark.py store [--sizes 10000,100000,1000000]
+"""
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from connection import Connection
+from manager import Manager
+import main as minode_main
+import message
+import shared
+import structure
+import vectorset
+
+
+def _memory(build):
+    """Bytes allocated by build() and still held by its result"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def _time(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def _vector_results(name, count, build, lookups):
+    memory = _memory(build)
+    container = build()
+    elapsed = _time(lambda: [v in container for v in lookups])
+    return {
+        'structure': name,
+        'count': count,
+        'memory': memory,
+        'bytes_per_vector': round(memory / count, 1),
+        'build_seconds': round(_time(build), 3),
+        'lookups_per_second': round(len(lookups) / elapsed),
+    }
+
+
+def benchmark_vectors(count):
+    """Memory and speed of vector containers compared with builtin ones"""
+    data = os.urandom(32 * count)
+
+    def vectors():
+        # New bytes objects, owned by the container like vectors parsed from messages
+        return (data[o:o + 32] for o in range(0, len(data), 32))
+
+    def build_vector_queue():
+        return vectorset.VectorQueue(vectors())
+
+    hits = [data[o:o + 32] for o in range(0, min(len(data), 32 * 100000), 32)]
+    lookups = hits + [os.urandom(32) for _ in range(len(hits))]
+
+    results = [
+        _vector_results('set', count, lambda: set(vectors()), lookups),
+        _vector_results('VectorSet', count, lambda: vectorset.VectorSet(vectors()), lookups),
+        _vector_results('OrderedDict', count, lambda: collections.OrderedDict.fromkeys(vectors()), lookups),
+        _vector_results('VectorQueue', count, build_vector_queue, lookups),
+    ]
+
+    # Bulk difference with an object store ten times smaller
+    store = dict.fromkeys(hits[::10])
+    s = set(vectors())
+    vs = vectorset.VectorSet(vectors())
+    results.append({'operation': 'set.difference(store)', 'seconds': round(_time(lambda: s.difference(store)), 3)})
+    results.append({'operation': 'VectorSet.difference(store)', 'seconds': round(_time(lambda: vs.difference(store)), 3)})
+    return results
+
+
+def _rate(name, function, size, min_time):
+    """Calls function until min_time passes, size is the number of bytes processed by one call"""
+    function()
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return {
+        'name': name,
+        'ops_per_second': round(calls / elapsed, 1),
+        'bytes_per_second': round(calls * size / elapsed),
+    }
+
+
+def _object(payload_size):
+    return structure.Object(
+        os.urandom(8), int(time.time() + 24 * 3600), 2, 1, 1, os.urandom(payload_size))
+
+
+def _addresses(count):
+    return {structure.NetAddr(1, '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255), 8444)
+            for i in range(count)}
+
+
+def benchmark_codec(min_time):
+    """Encoding and decoding of protocol structures and messages"""
+    results = []
+
+    varints = [1, 300, 70000, 2 ** 40]
+    encoded = [structure.VarInt(n).to_bytes() for n in varints]
+    results.append(_rate('VarInt.to_bytes', lambda: [structure.VarInt(n).to_bytes() for n in varints],
+                         sum(len(b) for b in encoded), min_time))
+    results.append(_rate('VarInt.from_bytes', lambda: [structure.VarInt.from_bytes(b) for b in encoded],
+                         sum(len(b) for b in encoded), min_time))
+
+    header = message.Message(b'object', b'x' * 1000).to_bytes()[:shared.header_length]
+    results.append(_rate('Header.from_bytes', lambda: message.Header.from_bytes(header), len(header), min_time))
+
+    for size in (100, 10000, 2 ** 18):
+        b = message.Message(b'object', os.urandom(size)).to_bytes()
+        results.append(_rate('Message.from_bytes[{}]'.format(size), lambda: message.Message.from_bytes(b), len(b), min_time))
+
+    for count in (1, 1000, 50000):
+        vectors = [os.urandom(32) for _ in range(count)]
+        for name, cls in (('Inv', message.Inv), ('GetData', message.GetData)):
+            m = cls(vectors)
+            b = m.to_bytes()
+            framed = message.Message.from_bytes(b)
+            results.append(_rate('{}.to_bytes[{}]'.format(name, count), m.to_bytes, len(b), min_time))
+            results.append(_rate('{}.from_message[{}]'.format(name, count), lambda: cls.from_message(framed), len(b), min_time))
+        m = message.Addr(_addresses(count))
+        b = m.to_bytes()
+        framed = message.Message.from_bytes(b)
+        results.append(_rate('Addr.to_bytes[{}]'.format(count), m.to_bytes, len(b), min_time))
+        results.append(_rate('Addr.from_message[{}]'.format(count), lambda: message.Addr.from_message(framed), len(b), min_time))
+
+    for size in (100, 1000, 10000, 100000, 2 ** 18):
+        obj = _object(size)
+        m = message.Message(b'object', obj.to_bytes())
+        results.append(_rate('Object.from_message[{}]'.format(size), lambda: structure.Object.from_message(m), len(m.payload), min_time))
+        # PoW of random objects is insufficient, which is checked last, so the work is the same
+        results.append(_rate('Object.is_valid[{}]'.format(size), obj.is_valid, len(m.payload), min_time))
+        results.append(_rate('Object.to_bytes[{}]'.format(size), obj.to_bytes, len(m.payload), min_time))
+
+    def receive(b, chunk=4096):
+        """Work done by a connection for a received object, most of the hashing as chunks arrive"""
+        hasher = message.PayloadHasher()
+        view = memoryview(b)
+        for i in range(chunk, len(b) + chunk, chunk):
+            hasher.update(view[:i])
+        payload_hash, pow_initial_hash = hasher.pop()
+        m = message.Message.from_bytes(b, payload_hash, pow_initial_hash)
+        structure.Object.from_message(m).is_valid(m.pow_initial_hash)
+
+    for size in (1000, 2 ** 18):
+        b = message.Message(b'object', _object(size).to_bytes()).to_bytes()
+        results.append(_rate('receive[{}]'.format(size), lambda: receive(b), len(b), min_time))
+
+    for host in ('192.0.2.1', '2001:db8::1'):
+        a = structure.NetAddr(1, host, 8444)
+        results.append(_rate('NetAddr.to_bytes[{}]'.format(host), a.to_bytes, 38, min_time))
+
+    # Framing and checksums of a stream of object messages, the messages are not processed
+    stream = b''.join(message.Message(b'object', _object(1000).to_bytes()).to_bytes() for _ in range(1000))
+    c = Connection('192.0.2.1', 8444)
+    c._process_message = lambda m: None
+
+    def process_stream():
+        c.buffer_receive = stream
+        c._process_buffer_receive()
+    results.append(_rate('Connection._process_buffer_receive[1000 objects]', process_stream, len(stream), min_time))
+
+    return results
+
+
+# Object types with their share of the inventory and median payload size
+OBJECT_TYPES = (
+    (0, 0.15, 100),  # getpubkey
+    (1, 0.15, 400),  # pubkey
+    (2, 0.60, 700),  # msg
+    (3, 0.10, 1000),  # broadcast
+)
+
+
+def _rss():
+    """Resident set size in bytes"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak instead of current on other systems, in kilobytes on Linux and in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _synthetic_objects(count, expired=0.1):
+    """Objects with realistic types and sizes, a fraction of them is expired"""
+    blob = os.urandom(2 ** 20)
+    types = [t for t, _, _ in OBJECT_TYPES]
+    weights = [w for _, w, _ in OBJECT_TYPES]
+    medians = {t: m for t, _, m in OBJECT_TYPES}
+    now = int(time.time())
+    for _ in range(count):
+        object_type = random.choices(types, weights)[0]
+        size = min(int(random.lognormvariate(0, 0.8) * medians[object_type]), 2 ** 18)
+        offset = random.randrange(len(blob) - size)
+        if random.random() < expired:
+            expires_time = now - 4 * 3600 - random.randrange(3600)
+        else:
+            expires_time = now + random.randrange(28 * 24 * 3600)
+        yield structure.Object(os.urandom(8), expires_time, object_type, 1, 1, blob[offset:offset + size])
+
+
+def benchmark_store_size(count):
+    """Memory and persistence costs of an object store of `count` objects, saved in a new directory"""
+    shared.data_directory = tempfile.mkdtemp(prefix='minode-benchmark-') + '/'
+    gc.collect()
+    rss_empty = _rss()
+
+    start = time.perf_counter()
+    payload_bytes = 0
+    for obj in _synthetic_objects(count):
+        payload_bytes += len(obj.object_payload)
+        with shared.objects_lock:
+            shared.objects[obj.vector] = obj
+    generate_seconds = time.perf_counter() - start
+    gc.collect()
+    rss_full = _rss()
+
+    start = time.perf_counter()
+    Manager.pickle_objects()
+    persist_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Manager.clean_objects()
+    clean_seconds = time.perf_counter() - start
+
+    return {
+        'name': 'store[{}]'.format(count),
+        'objects': count,
+        'payload_bytes': payload_bytes,
+        'rss_empty': rss_empty,
+        'rss_full': rss_full,
+        'bytes_per_object': round((rss_full - rss_empty) / count),
+        'overhead_per_object': round((rss_full - rss_empty - payload_bytes) / count),
+        'pickle_size': os.path.getsize(shared.data_directory + 'objects.pickle'),
+        'generate_seconds': round(generate_seconds, 3),
+        'persist_seconds': round(persist_seconds, 3),
+        'clean_seconds': round(clean_seconds, 3),
+        'objects_after_clean': len(shared.objects),
+        'data_directory': shared.data_directory,
+    }
+
+
+def benchmark_store_load(data_directory):
+    """Startup costs of loading saved objects"""
+    shared.data_directory = data_directory
+    gc.collect()
+    rss_empty = _rss()
+    start = time.perf_counter()
+    minode_main.load_data()
+    load_seconds = time.perf_counter() - start
+    gc.collect()
+    return {
+        'rss_after_load': _rss(),
+        'load_bytes_per_object': round((_rss() - rss_empty) / max(len(shared.objects), 1)),
+        'load_seconds': round(load_seconds, 3),
+    }
+
+
+def _run_child(*args):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'store', '--in-process'] + list(args))
+    return json.loads(output.decode())
+
+
+def benchmark_store(sizes):
+    """Every size and loading run in new processes so that memory measurements don't affect each other"""
+    results = []
+    for count in sizes:
+        result = _run_child('--sizes', str(count))[0]
+        data_directory = result.pop('data_directory')
+        try:
+            result.update(_run_child('--load', data_directory)[0])
+        finally:
+            shutil.rmtree(data_directory)
+        results.append(result)
+    return results
+
+
+def compare(results, baseline):
+    """Adds ops per second of the baseline and the ratio to them"""
+    previous = {r['name']: r for r in baseline if 'ops_per_second' in r}
+    for r in results:
+        if 'ops_per_second' in r and r['name'] in previous:
+            before = previous[r['name']]['ops_per_second']
+            r['baseline_ops_per_second'] = before
+            r['speedup'] = round(r['ops_per_second'] / before, 3) if before else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MiNode benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    vectors_parser = subparsers.add_parser('vectors', help='Vector containers')
+    vectors_parser.add_argument('--count', help='Number of vectors', type=int, default=1000000)
+    codec_parser = subparsers.add_parser('codec', help='Encoding and decoding of messages')
+    codec_parser.add_argument('--time', help='Minimum seconds per case', type=float, default=0.5)
+    store_parser = subparsers.add_parser('store', help='Memory and persistence of the object store')
+    store_parser.add_argument('--sizes', help='Comma separated numbers of objects', default='10000,100000,1000000')
+    store_parser.add_argument('--in-process', help=argparse.SUPPRESS, action='store_true')
+    store_parser.add_argument('--load', help=argparse.SUPPRESS, metavar='DIR')
+    for p in (vectors_parser, codec_parser, store_parser):
+        p.add_argument('--save', help='Save results to a file', metavar='FILE')
+        p.add_argument('--baseline', help='Compare with results saved earlier', metavar='FILE')
+    args = parser.parse_args()
+    # Objects with insufficient PoW would be logged on every call
+    logging.disable(logging.CRITICAL)
+
+    if args.benchmark == 'vectors':
+        results = benchmark_vectors(args.count)
+    elif args.benchmark == 'codec':
+        results = benchmark_codec(args.time)
+    elif args.benchmark == 'store':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        if args.load:
+            results = [benchmark_store_load(args.load)]
+        elif args.in_process:
+            results = [benchmark_store_size(count) for count in sizes]
+        else:
+            results = benchmark_store(sizes)
+    if args.baseline:
+        with open(args.baseline) as file:
+            results = compare(results, json.load(file))
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
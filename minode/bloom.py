@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import os
+import threading
+import time
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def add(self, h1, h2):
+        for k in range(self.hashes):
+            i = (h1 + k * h2) % self.bits
+            self.array[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def contains(self, h1, h2):
+        array, bits = self.array, self.bits
+        for k in range(self.hashes):
+            i = (h1 + k * h2) % bits
+            if not array[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+
+class RollingBloomFilter(object):
+    """
+    Remembers items for at least period / 2 and at most period seconds,
+    using two Bloom filters of capacity / 2 items each
+    """
+    def __init__(self, capacity, period, error_rate=1e-6):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.period = period
+        self.error_rate = error_rate
+        self.key = os.urandom(16)
+        self.generations = [self._new_generation(), self._new_generation()]
+        self.rotated = time.monotonic()
+
+        self.added = 0
+        self.added_bytes = 0
+        self.hits = 0
+        self.hit_bytes = 0
+        self.checks_skipped = 0
+        self.checks_skipped_bytes = 0
+
+    def __repr__(self):
+        return 'rolling_bloom_filter, capacity: {}, period: {}, items: {}'.format(
+            self.capacity, self.period, sum(g.count for g in self.generations))
+
+    def __len__(self):
+        return sum(g.count for g in self.generations)
+
+    def _new_generation(self):
+        return BloomFilter(max(self.capacity // 2, 1), self.error_rate)
+
+    def _hash(self, item):
+        h = hashlib.blake2b(item, digest_size=16, key=self.key).digest()
+        return int.from_bytes(h[:8], 'big'), int.from_bytes(h[8:], 'big') | 1
+
+    def _rotate(self):
+        if self.generations[-1].count >= self.capacity // 2 or time.monotonic() - self.rotated > self.period / 2:
+            self.generations = [self.generations[-1], self._new_generation()]
+            self.rotated = time.monotonic()
+
+    def add(self, item, size=0):
+        """`size` is the number of bytes we don't need to download again"""
+        h1, h2 = self._hash(item)
+        with self.lock:
+            self._rotate()
+            if self.generations[-1].contains(h1, h2):
+                return
+            self.generations[-1].add(h1, h2)
+            self.added += 1
+            self.added_bytes += size
+
+    def __contains__(self, item):
+        if not self.added:
+            return False
+        h1, h2 = self._hash(item)
+        with self.lock:
+            self._rotate()
+            return any(g.contains(h1, h2) for g in self.generations)
+
+    def filter(self, items):
+        """Removes items in the filter from the set `items`, counts them as hits"""
+        if not self.added:
+            return
+        with self.lock:
+            self._rotate()
+            generations = self.generations
+        found = set()
+        for item in items:
+            h1, h2 = self._hash(item)
+            if any(g.contains(h1, h2) for g in generations):
+                found.add(item)
+        if found:
+            items.difference_update(found)
+            self.hit(len(found))
+
+    def hit(self, count=1, size=None):
+        """
+        Counts items we did not download or validate again, the size is
+        estimated from the average size of added items if unknown
+        """
+        with self.lock:
+            self.hits += count
+            if size is None:
+                size = count * self.added_bytes // max(self.added, 1)
+            self.hit_bytes += size
+
+    def skip_check(self, size):
+        """Counts items received again which we did not need to validate"""
+        with self.lock:
+            self.checks_skipped += 1
+            self.checks_skipped_bytes += size
+
+    def stats(self):
+        return {
+            'items': len(self), 'added': self.added, 'hits': self.hits, 'bytes_saved': self.hit_bytes,
+            'checks_skipped': self.checks_skipped, 'checks_skipped_bytes': self.checks_skipped_bytes}
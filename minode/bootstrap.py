@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Warm start: outgoing peers connected before shutdown are saved and
+dialed first on start, DNS bootstrap only runs when they are not enough.
+"""
+import logging
+import pickle
+import socket
+import threading
+import time
+
+import shared
+import workers
+
+
+def bootstrap_from_dns():
+    try:
+        for item in socket.getaddrinfo('bootstrap8080.bitmessage.org', 80):
+            shared.unchecked_node_pool.add((item[4][0], 8080))
+            logging.debug('Adding ' + item[4][0] + ' to unchecked_node_pool based on DNS bootstrap method')
+        for item in socket.getaddrinfo('bootstrap8444.bitmessage.org', 80):
+            shared.unchecked_node_pool.add((item[4][0], 8444))
+            logging.debug('Adding ' + item[4][0] + ' to unchecked_node_pool based on DNS bootstrap method')
+    except Exception as e:
+        logging.error('Error during DNS bootstrap')
+        logging.error(e)
+
+
+def load_warm_peers():
+    try:
+        with open(shared.data_directory + 'warm_peers.pickle', mode='br') as file:
+            shared.warm_peers = tuple(pickle.load(file))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning('Error while loading warm peers from disk.')
+        logging.warning(e)
+
+
+def save_warm_peers():
+    """Saves established outgoing peers, best first"""
+    connections = [c for c in shared.connections.select(server=False) if c.established_time is not None]
+    peers = [(c.host, c.port) for c in sorted(connections, key=lambda c: c.score(), reverse=True)]
+    try:
+        with open(shared.data_directory + 'warm_peers.pickle', mode='bw') as file:
+            pickle.dump(peers, file, protocol=3)
+    except Exception as e:
+        logging.warning('Error while saving warm peers')
+        logging.warning(e)
+
+
+class Bootstrapper(threading.Thread):
+    """Runs DNS bootstrap if needed and logs how fast outgoing connections were established"""
+    def __init__(self):
+        super().__init__(name='Bootstrapper', daemon=True)
+        self.start_time = time.time()
+        # Numbers of established outgoing connections worth logging, each is logged once
+        self.milestones = sorted({1, max(shared.outgoing_connections // 2, 1), max(shared.outgoing_connections, 1)})
+        self.enough = threading.Event()
+        # The Manager takes warm peers as soon as it starts
+        self.warm_peers = [addr for addr in shared.warm_peers if workers.owns(addr[0])]
+        shared.connections.listeners.append(self._on_status)
+
+    @staticmethod
+    def established():
+        """Outgoing connections established at the moment, a peer which reconnected counts once"""
+        return len(shared.connections.select('fully_established', server=False))
+
+    def _on_status(self, c, old_status, new_status):
+        if c.server or new_status != 'fully_established' or self.enough.is_set():
+            return
+        established = self.established()
+        while self.milestones and established >= self.milestones[0]:
+            logging.info('Established {} outgoing connections in {:.1f} seconds'.format(
+                self.milestones.pop(0), time.time() - self.start_time))
+        if not self.milestones:
+            self.enough.set()
+
+    def run(self):
+        if not shared.ip_enabled or shared.trusted_peer or not shared.send_outgoing_connections:
+            return
+        if len(self.warm_peers) >= shared.outgoing_connections:
+            logging.info('Dialing {} peers from the last run'.format(len(self.warm_peers)))
+            # Dialing warm peers, bootstrap if a half of them did not work out
+            self.enough.wait(shared.warm_start_timeout)
+            established = self.established()
+            if established >= max(shared.outgoing_connections // 2, 1):
+                return
+            logging.info('Only {} warm peers connected, bootstrapping from DNS'.format(established))
+        bootstrap_from_dns()
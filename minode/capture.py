@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Capture of received messages, enabled with --capture DIR.
+
+Each connection is written to its own file: MAGIC, length of metadata
+(2 bytes), metadata as JSON, then for every message its receive time
+(8-byte double), its length (4 bytes) and the message with its header.
+"""
+import json
+import os
+import re
+import struct
+import time
+
+MAGIC = b'MiNode capture\x00\x01'
+RECORD = struct.Struct('>dL')
+
+
+class CaptureWriter(object):
+    def __init__(self, directory, connection):
+        name = '{}-{}-{}.capture'.format(
+            time.strftime('%Y%m%d-%H%M%S'), re.sub(r'[^0-9A-Za-z.-]', '_', str(connection.host_print)), connection.port)
+        self.path = os.path.join(directory, name)
+        self.file = open(self.path, mode='bw')
+        metadata = json.dumps({
+            'host': str(connection.host_print), 'port': str(connection.port), 'network': connection.network,
+            'server': connection.server, 'start': time.time()}).encode()
+        self.file.write(MAGIC + struct.pack('>H', len(metadata)) + metadata)
+
+    def write(self, data):
+        self.file.write(RECORD.pack(time.time(), len(data)) + data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Returns metadata and a generator of (time, message) pairs"""
+    file = open(path, mode='br')
+    if file.read(len(MAGIC)) != MAGIC:
+        file.close()
+        raise ValueError('{} is not a MiNode capture'.format(path))
+    length, = struct.unpack('>H', file.read(2))
+    metadata = json.loads(file.read(length).decode())
+
+    def records():
+        with file:
+            while True:
+                header = file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                t, length = RECORD.unpack(header)
+                data = file.read(length)
+                if len(data) < length:
+                    # Capture of a connection which was still open
+                    break
+                yield t, data
+
+    return metadata, records()
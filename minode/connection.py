@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import base64
+import collections
 import errno
+import itertools
 import logging
+import os
 import random
 import select
 import socket
@@ -10,9 +13,78 @@ import threading
 import queue
 import time
 
+import admission
+import capture
 import message
+import ratelimit
+import reconciliation
+import scoring
 import shared
 import structure
+import tracer
+import vectorset
+import window
+import workers
+
+
+# Approximate memory taken by one vector stored in a set or a dict
+VECTOR_ENTRY_SIZE = 120
+
+
+class SendQueue(object):
+    """Outgoing message queue which hands out control messages first, then inventory messages and objects last"""
+    CONTROL = 0
+    INVENTORY = 1
+    OBJECT = 2
+
+    def __init__(self):
+        self.queues = (collections.deque(), collections.deque(), collections.deque())
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+    @classmethod
+    def priority(cls, m):
+        if type(m) in (message.Message, message.FramedMessage) and m.command == b'object':
+            return cls.OBJECT
+        if type(m) in (message.Inv, message.GetData, message.Addr, message.Sketch):
+            return cls.INVENTORY
+        if type(m) == message.FramedMessage and m.command in (b'inv', b'getdata', b'addr'):
+            return cls.INVENTORY
+        # verack, ping, pong, version and internal markers
+        return cls.CONTROL
+
+    @staticmethod
+    def size(m):
+        """Approximate number of bytes m will take when encoded"""
+        if type(m) in (message.Message, message.FramedMessage):
+            return shared.header_length + m.payload_length
+        if type(m) in (message.Inv, message.GetData):
+            return shared.header_length + 9 + 32 * len(m.vectors)
+        if type(m) == message.Addr:
+            return shared.header_length + 9 + 38 * len(m.addresses)
+        if type(m) == message.Sketch:
+            return reconciliation.sketch_size(m.iblt.cells)
+        return shared.header_length
+
+    def put(self, m):
+        with self.lock:
+            self.queues[self.priority(m)].append(m)
+            self.bytes += self.size(m)
+
+    def get(self):
+        with self.lock:
+            for q in self.queues:
+                if q:
+                    m = q.popleft()
+                    self.bytes -= self.size(m)
+                    return m
+        raise queue.Empty
+
+    def empty(self):
+        return not any(self.queues)
+
+    def qsize(self):
+        return sum(len(q) for q in self.queues)
 
 
 class Connection(threading.Thread):
@@ -29,17 +101,24 @@ class Connection(threading.Thread):
 
         super().__init__(name='Connection to {}:{}'.format(host, port))
 
-        self.send_queue = queue.Queue()
+        self.send_queue = SendQueue()
 
         self.vectors_to_get = set()
-        self.vectors_to_send = set()
+        # Objects are sent in order of requests, compact as it can be long and live long
+        self.vectors_to_send = vectorset.VectorQueue()
 
         self.vectors_requested = dict()
+        self.vectors_retried = set()
+        # Inventory put aside while the node is overloaded
+        self.vectors_deferred = set()
+        self.request_window = window.RequestWindow()
 
-        self.status = 'ready'
+        self._status = 'ready'
 
         self.tls = False
 
+        self.capture = None
+
         self.verack_received = False
         self.verack_sent = False
 
@@ -53,7 +132,12 @@ class Connection(threading.Thread):
             self.status = 'connected'
 
         self.buffer_receive = b''
+        self.payload_hasher = message.PayloadHasher()
         self.buffer_send = b''
+        self.send_retry_size = 0
+
+        self.upload_bucket = ratelimit.TokenBucket(shared.peer_upload_limit)
+        self.download_bucket = ratelimit.TokenBucket(shared.peer_download_limit)
 
         self.next_message_size = shared.header_length
         self.next_header = True
@@ -61,13 +145,52 @@ class Connection(threading.Thread):
 
         self.last_message_received = time.time()
         self.last_message_sent = time.time()
+        self.last_request_check = 0
+
+        self.sketches_sent = 0
+        self.sync_bytes = 0
+        # Full inv is sent at most once, sketches from the peer are rate limited
+        self.inventory_synced = False
+        self.sketch_bucket = ratelimit.TokenBucket(0.1, 3)
+
+        self.objects_served = ratelimit.RateMeter()
+        self.bytes_served = ratelimit.RateMeter()
+
+        self.start_time = time.time()
+        self.established_time = None
+        self.handshake_time = None
+        self.bytes_received = 0
+        self.objects_new = 0
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        shared.connections.set_status(self, status)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            if self.capture:
+                self.capture.close()
+            # The Manager removes failed and disconnected connections
+            if self.status != 'failed':
+                self.status = 'disconnected'
+
+    def _run(self):
         if self.s is None:
             self._connect()
         if self.status != 'connected':
             return
         self.s.settimeout(0)
+        if shared.capture_directory:
+            try:
+                self.capture = capture.CaptureWriter(shared.capture_directory, self)
+            except OSError as e:
+                logging.warning('Could not start capture of {}:{}: {}'.format(self.host_print, self.port, e))
         if not self.server:
             if self.network == 'ip':
                 self.send_queue.put(message.Version(self.host, self.port))
@@ -79,13 +202,16 @@ class Connection(threading.Thread):
             data = True
             try:
                 if self.status == 'fully_established':
-                        data = self.s.recv(4096)
-                        self.buffer_receive += data
+                    size = self._receive_allowance()
+                    if size:
+                        data = self._receive(size)
                         if data and len(self.buffer_receive) < 4000000:
                             continue
+                    else:
+                        self._request_objects()
+                        self._send_objects()
                 else:
-                    data = self.s.recv(self.next_message_size - len(self.buffer_receive))
-                    self.buffer_receive += data
+                    data = self._receive(self.next_message_size - len(self.buffer_receive))
             except ssl.SSLWantReadError:
                 if self.status == 'fully_established':
                     self._request_objects()
@@ -103,7 +229,6 @@ class Connection(threading.Thread):
                 logging.debug('Disconnecting from {}:{}. Reason: ConnectionResetError'.format(self.host_print, self.port))
                 self.status = 'disconnecting'
             self._process_buffer_receive()
-            self._process_queue()
             self._send_data()
             if time.time() - self.last_message_received > shared.timeout:
                 logging.debug(
@@ -124,7 +249,7 @@ class Connection(threading.Thread):
                 self.s.close()
                 logging.info('Disconnected from {}:{}'.format(self.host_print, self.port))
                 break
-            time.sleep(0.2)
+            self._wait()
 
     def _connect(self):
         logging.debug('Connecting to {}:{}'.format(self.host_print, self.port))
@@ -137,16 +262,110 @@ class Connection(threading.Thread):
             logging.warning('Connection to {}:{} failed. Reason: {}'.format(self.host_print, self.port, e))
             self.status = 'failed'
 
+    def _receive_allowance(self):
+        if self.send_backlog() > shared.send_backlog_limit:
+            # Do not read more requests until they read what we already have for them
+            return 0
+        return ratelimit.allowance(4096, self.download_bucket, ratelimit.download)
+
+    def _wait(self):
+        """Sleeps until the socket becomes readable or, if we have something to send, writable, at most 0.2 s"""
+        if self.tls and self.s.pending():
+            return
+        read = [self.s] if self.status != 'fully_established' or self._receive_allowance() else []
+        write = []
+        timeout = shared.select_timeout
+        serving = self.status == 'fully_established' and self.vectors_to_send \
+            and self.send_backlog() < shared.send_budget
+        if self.buffer_send or not self.send_queue.empty() or serving:
+            if ratelimit.allowance(1, self.upload_bucket, ratelimit.upload):
+                write = [self.s]
+            else:
+                # Upload limit reached, wake up when a chunk can be sent
+                size = min(max(len(self.buffer_send), 1), 4096)
+                timeout = min(timeout, ratelimit.delay(size, self.upload_bucket, ratelimit.upload))
+        try:
+            select.select(read, write, [], timeout)
+        except (OSError, ValueError) as e:
+            logging.debug('Disconnecting from {}:{}. Reason: {}'.format(self.host_print, self.port, e))
+            self.status = 'disconnecting'
+
+    def send_backlog(self):
+        return len(self.buffer_send) + self.send_queue.bytes
+
+    def memory_usage(self):
+        """Approximate number of bytes held by this connection"""
+        vectors = len(self.vectors_to_get) + len(self.vectors_requested) + len(self.vectors_retried) + len(self.vectors_deferred)
+        vectors = vectors * VECTOR_ENTRY_SIZE + self.vectors_to_send.memory_size()
+        return len(self.buffer_receive) + self.send_backlog() + vectors
+
+    def score(self):
+        if self.established_time is None:
+            return None
+        return scoring.score(self)
+
+    def stats(self):
+        score = self.score()
+        return {
+            'score': None if score is None else round(score, 2),
+            'objects_new': self.objects_new,
+            'memory': self.memory_usage(),
+            'send_backlog': self.send_backlog(),
+            'receive_buffer': len(self.buffer_receive),
+            'vectors_to_get': len(self.vectors_to_get),
+            'vectors_to_send': len(self.vectors_to_send),
+            'vectors_requested': len(self.vectors_requested),
+            'vectors_deferred': len(self.vectors_deferred),
+            'sync_bytes': self.sync_bytes,
+            'request_window': int(self.request_window.size),
+            'request_timeout': round(self.request_window.timeout(), 1),
+            'objects_received': self.request_window.delivered.total,
+            'objects_per_second': round(self.request_window.delivered.rate(), 2),
+            'objects_served': self.objects_served.total,
+            'objects_served_per_second': round(self.objects_served.rate(), 2),
+            'bytes_served_per_second': round(self.bytes_served.rate()),
+        }
+
+    def _receive(self, size):
+        data = self.s.recv(size)
+        ratelimit.consume(len(data), self.download_bucket, ratelimit.download)
+        self.bytes_received += len(data)
+        self.buffer_receive += data
+        self.payload_hasher.update(self.buffer_receive)
+        return data
+
     def _send_data(self):
-        if self.buffer_send and self:
+        while True:
+            # When disconnecting, what is already buffered gets one last send, e.g. a final error message
+            last = self.status == 'disconnecting'
+            if not last:
+                self._process_queue()
+            if not self.buffer_send:
+                break
+            if last:
+                size = len(self.buffer_send)
+            else:
+                size = ratelimit.allowance(len(self.buffer_send), self.upload_bucket, ratelimit.upload)
+            # OpenSSL requires a retried write to be at least as long as the failed one
+            size = max(size, self.send_retry_size)
+            if not size:
+                break
             try:
-                amount = self.s.send(self.buffer_send)
+                amount = self.s.send(self.buffer_send[:size])
+                self.send_retry_size = 0
+                ratelimit.consume(amount, self.upload_bucket, ratelimit.upload)
                 self.buffer_send = self.buffer_send[amount:]
-            except (BlockingIOError, ssl.SSLWantWriteError):
-                pass
+            except BlockingIOError:
+                break
+            except ssl.SSLWantWriteError:
+                self.send_retry_size = size
+                break
             except (BrokenPipeError, ConnectionResetError, ssl.SSLError, OSError) as e:
                 logging.debug('Disconnecting from {}:{}. Reason: {}'.format(self.host_print, self.port, e))
                 self.status = 'disconnecting'
+                break
+            if amount < size or last:
+                break
 
     def _do_tls_handshake(self):
         logging.debug('Initializing TLS connection with {}:{}'.format(self.host_print, self.port))
@@ -182,10 +401,7 @@ class Connection(threading.Thread):
         logging.debug('Established TLS connection with {}:{}'.format(self.host_print, self.port))
 
     def _send_message(self, m):
-        if type(m) == message.Message and m.command == b'object':
-            logging.debug('{}:{} <- {}'.format(self.host_print, self.port, structure.Object.from_message(m)))
-        else:
-            logging.debug('{}:{} <- {}'.format(self.host_print, self.port, m))
+        logging.debug('{}:{} <- {}'.format(self.host_print, self.port, m))
         self.buffer_send += m.to_bytes()
 
     def _on_connection_fully_established(self):
@@ -194,7 +410,7 @@ class Connection(threading.Thread):
         if self.remote_version.services & 2 and self.network == 'ip':  # NODE_SSL
             self._do_tls_handshake()
 
-        addr = {structure.NetAddr(c.remote_version.services, c.host, c.port) for c in shared.connections if c.network != 'i2p' and c.server is False and c.status == 'fully_established'}
+        addr = {structure.NetAddr(c.remote_version.services, c.host, c.port) for c in shared.connections.select('fully_established', 'ip', False)}
         if len(shared.node_pool) > 10:
             addr.update({structure.NetAddr(1, a[0], a[1]) for a in random.sample(shared.node_pool, 10)})
         if len(shared.unchecked_node_pool) > 10:
@@ -202,22 +418,52 @@ class Connection(threading.Thread):
         if len(addr) != 0:
             self.send_queue.put(message.Addr(addr))
 
-        with shared.objects_lock:
-            if len(shared.objects) > 0:
-                to_send = {vector for vector in shared.objects.keys() if shared.objects[vector].expires_time > time.time()}
-                while len(to_send) > 0:
-                    if len(to_send) > 10000:
-                        # We limit size of inv messaged to 10000 entries because they might time out in very slow networks (I2P)
-                        pack = random.sample(to_send, 10000)
-                        self.send_queue.put(message.Inv(pack))
-                        to_send.difference_update(pack)
-                    else:
-                        self.send_queue.put(message.Inv(to_send))
-                        to_send.clear()
+        self._sync_inventory(shared.sketch_cells)
+        self.established_time = time.time()
+        self.handshake_time = self.established_time - self.start_time
         self.status = 'fully_established'
 
+    @staticmethod
+    def _unexpired_vectors():
+        with shared.objects_lock:
+            return {vector for vector in shared.objects.keys() if shared.objects[vector].expires_time > time.time()}
+
+    def _reconciliation(self):
+        """Both sides support reconciliation sketches"""
+        return self.remote_version is not None \
+            and bool(self.remote_version.services & shared.services & shared.service_reconciliation)
+
+    def _sync_inventory(self, cells):
+        """Sends a sketch of our inventory to MiNode peers or all our vectors in inv messages"""
+        if self.inventory_synced:
+            return
+        to_send = self._unexpired_vectors()
+        inv_size = reconciliation.inv_size(len(to_send))
+        if self._reconciliation() and self.sketches_sent < 3 and reconciliation.sketch_size(cells) < inv_size:
+            sketch = message.Sketch(len(to_send), reconciliation.IBLT.from_vectors(to_send, cells, os.urandom(8)))
+            self.send_queue.put(sketch)
+            self.sketches_sent += 1
+            self.sync_bytes += reconciliation.sketch_size(sketch.iblt.cells)
+            logging.debug('Inventory sync with {}:{}: {} bytes sent in {} sketches, inv would take {} bytes'.format(
+                self.host_print, self.port, self.sync_bytes, self.sketches_sent, inv_size))
+            return
+        while len(to_send) > 0:
+            if len(to_send) > shared.inv_chunk_size:
+                # We limit size of inv messages because they might time out in very slow networks (I2P)
+                pack = random.sample(to_send, shared.inv_chunk_size)
+                self.send_queue.put(message.Inv(pack))
+                to_send.difference_update(pack)
+            else:
+                self.send_queue.put(message.Inv(to_send))
+                to_send.clear()
+        self.inventory_synced = True
+        self.sync_bytes += inv_size
+        if self.sketches_sent:
+            logging.debug('Inventory sync with {}:{}: falling back to inv, {} bytes sent in total'.format(
+                self.host_print, self.port, self.sync_bytes))
+
     def _process_queue(self):
-        while not self.send_queue.empty():
+        while not self.send_queue.empty() and len(self.buffer_send) < shared.send_buffer_size:
             m = self.send_queue.get()
             if m:
                 if m == 'fully_established':
@@ -225,11 +471,14 @@ class Connection(threading.Thread):
                 else:
                     self._send_message(m)
                     self.last_message_sent = time.time()
+                    if type(m) == message.FramedMessage and m.vectors is not None:
+                        tracer.record(m.vectors, 'inv_sent', self)
             else:
                 self.status = 'disconnecting'
                 break
 
     def _process_buffer_receive(self):
+        self.payload_hasher.update(self.buffer_receive)
         while len(self.buffer_receive) >= self.next_message_size:
             if self.next_header:
                 self.next_header = False
@@ -242,13 +491,18 @@ class Connection(threading.Thread):
                 self.next_message_size += h.payload_length
             else:
                 try:
-                    m = message.Message.from_bytes(self.buffer_receive[:self.next_message_size])
+                    payload_hash, pow_initial_hash = self.payload_hasher.pop()
+                    m = message.Message.from_bytes(
+                        self.buffer_receive[:self.next_message_size], payload_hash, pow_initial_hash)
                 except ValueError as e:
                     self.status = 'disconnecting'
                     logging.warning('Received malformed message from {}:{}, {}'.format(self.host_print, self.port, e))
                     break
                 self.next_header = True
+                if self.capture:
+                    self.capture.write(self.buffer_receive[:self.next_message_size])
                 self.buffer_receive = self.buffer_receive[self.next_message_size:]
+                self.payload_hasher.consume(self.next_message_size)
                 self.next_message_size = shared.header_length
                 self.last_message_received = time.time()
                 try:
@@ -272,12 +526,12 @@ class Connection(threading.Thread):
                 if not self.server:
                     self.send_queue.put('fully_established')
                     if self.network == 'ip':
-                        shared.address_advertise_queue.put(structure.NetAddr(version.services, self.host, self.port))
+                        self._advertise_address(structure.NetAddr(version.services, self.host, self.port))
                         shared.node_pool.add((self.host, self.port))
                     elif self.network == 'i2p':
                         shared.i2p_node_pool.add((self.host, 'i2p'))
                 if self.network == 'ip':
-                    shared.address_advertise_queue.put(structure.NetAddr(shared.services, version.host, shared.listening_port))
+                    self._advertise_address(structure.NetAddr(shared.services, version.host, shared.listening_port))
                 if self.server:
                     if self.network == 'ip':
                         self.send_queue.put(message.Version(self.host, self.port))
@@ -293,31 +547,89 @@ class Connection(threading.Thread):
         elif m.command == b'inv':
             inv = message.Inv.from_message(m)
             logging.debug('{}:{} -> {}'.format(self.host_print, self.port, inv))
-            to_get = inv.vectors.copy()
-            to_get.difference_update(shared.objects.keys())
-            self.vectors_to_get.update(to_get)
+            if admission.overloaded() and self.low_ratio():
+                self._defer_vectors(inv.vectors)
+            else:
+                self._process_inv(inv.vectors)
             # Do not send objects they already have.
-            self.vectors_to_send.difference_update(inv.vectors)
+            if self.vectors_to_send:
+                for vector in inv.vectors:
+                    self.vectors_to_send.discard(vector)
+
+        elif m.command == b'sketch':
+            if not self._reconciliation():
+                logging.debug('{}:{} -> sketch, reconciliation not negotiated, ignoring'.format(self.host_print, self.port))
+                return
+            sketch = message.Sketch.from_message(m)
+            logging.debug('{}:{} -> {}'.format(self.host_print, self.port, sketch))
+            # Building our table takes a pass over the whole inventory
+            if self.sketch_bucket.available() < 1:
+                logging.debug('Too many sketches from {}:{}, ignoring'.format(self.host_print, self.port))
+                return
+            self.sketch_bucket.consume(1)
+            vectors = self._unexpired_vectors()
+            ours = reconciliation.IBLT.from_vectors(vectors, sketch.iblt.cells, sketch.iblt.salt)
+            to_get, _, success = sketch.iblt.subtract(ours).decode()
+            if success:
+                to_get.difference_update(shared.objects.keys())
+                shared.tombstones.filter(to_get)
+                tracer.record(to_get, 'inv_received', self)
+                self._want_vectors(to_get)
+            else:
+                # The difference is at least the difference of sizes, ask for a table twice as big
+                cells = max(2 * sketch.iblt.cells, 3 * abs(sketch.set_size - len(vectors)))
+                self.send_queue.put(message.SketchFail(min(cells, reconciliation.MAX_CELLS)))
+
+        elif m.command == b'sketchfail':
+            if not self._reconciliation():
+                logging.debug('{}:{} -> sketchfail, reconciliation not negotiated, ignoring'.format(self.host_print, self.port))
+                return
+            fail = message.SketchFail.from_message(m)
+            logging.debug('{}:{} -> {}'.format(self.host_print, self.port, fail))
+            self._sync_inventory(min(fail.cells, reconciliation.MAX_CELLS))
 
         elif m.command == b'object':
             obj = structure.Object.from_message(m)
             logging.debug('{}:{} -> {}'.format(self.host_print, self.port, obj))
-            self.vectors_requested.pop(obj.vector, None)
+            tracer.record((obj.vector,), 'object_received', self)
+            requested = self.vectors_requested.pop(obj.vector, None)
+            if requested:
+                self.request_window.on_delivery(time.time() - requested)
+            self.vectors_retried.discard(obj.vector)
             self.vectors_to_get.discard(obj.vector)
-            if obj.is_valid() and obj.vector not in shared.objects:
+            if obj.vector in shared.objects:
+                pass
+            elif obj.vector in shared.tombstones:
+                # Known to be invalid, don't check PoW again
+                shared.tombstones.skip_check(len(m.payload))
+            elif not self._validate(obj, m.pow_initial_hash):
+                shared.tombstones.add(obj.vector, len(m.payload))
+            else:
+                tracer.record((obj.vector,), 'validated', self)
                 with shared.objects_lock:
                     shared.objects[obj.vector] = obj
+                tracer.record((obj.vector,), 'stored', self)
+                self.objects_new += 1
+                workers.share_object(obj)
                 if obj.object_type == shared.i2p_dest_obj_type and obj.version == shared.i2p_dest_obj_version:
                     dest = base64.b64encode(obj.object_payload, altchars=b'-~')
                     logging.debug('Received I2P destination object, adding to i2p_unchecked_node_pool')
                     logging.debug(dest)
                     shared.i2p_unchecked_node_pool.add((dest, 'i2p'))
-                shared.vector_advertise_queue.put(obj.vector)
+                try:
+                    shared.vector_advertise_queue.put_nowait(obj.vector)
+                    tracer.record((obj.vector,), 'advertise_queued')
+                except queue.Full:
+                    logging.warning('Vector advertise queue is full, not advertising {}'.format(obj))
 
         elif m.command == b'getdata':
             getdata = message.GetData.from_message(m)
             logging.debug('{}:{} -> {}'.format(self.host_print, self.port, getdata))
-            self.vectors_to_send.update(getdata.vectors)
+            room = max(shared.max_vectors_to_send - len(self.vectors_to_send), 0)
+            if len(getdata.vectors) > room:
+                logging.debug('Ignoring {} requested vectors from {}:{}, limit reached'.format(len(getdata.vectors) - room, self.host_print, self.port))
+                getdata.vectors = getdata.vectors[:room]
+            self.vectors_to_send.extend(getdata.vectors)
 
         elif m.command == b'addr':
             addr = message.Addr.from_message(m)
@@ -335,36 +647,104 @@ class Connection(threading.Thread):
         else:
             logging.debug('{}:{} -> {}'.format(self.host_print, self.port, m))
 
-    def _request_objects(self):
-        if self.vectors_to_get and len(self.vectors_requested) < 100:
-            self.vectors_to_get.difference_update(shared.objects.keys())
-            if self.vectors_to_get:
-                if len(self.vectors_to_get) > 64:
-                    pack = random.sample(self.vectors_to_get, 64)
-                    self.send_queue.put(message.GetData(pack))
-                    self.vectors_requested.update({vector: time.time() for vector in pack if vector not in self.vectors_requested})
-                    self.vectors_to_get.difference_update(pack)
-                else:
-                    self.send_queue.put(message.GetData(self.vectors_to_get))
-                    self.vectors_requested.update({vector: time.time() for vector in self.vectors_to_get if vector not in self.vectors_requested})
-                    self.vectors_to_get.clear()
+    def _process_inv(self, vectors):
+        to_get = {vector for vector in vectors if vector not in shared.objects}
+        shared.tombstones.filter(to_get)
+        tracer.record(to_get, 'inv_received', self)
+        self._want_vectors(to_get)
+
+    def _defer_vectors(self, vectors):
+        room = max(shared.max_vectors_to_get - len(self.vectors_deferred), 0)
+        if len(vectors) > room:
+            logging.debug('Ignoring {} deferred vectors from {}:{}, limit reached'.format(len(vectors) - room, self.host_print, self.port))
+            vectors = itertools.islice(vectors, room)
+        self.vectors_deferred.update(vectors)
+
+    @staticmethod
+    def _validate(obj, initial_hash=None):
+        start = time.monotonic()
+        valid = obj.is_valid(initial_hash)
+        admission.control.validated(time.monotonic() - start)
+        return valid
+
+    def low_ratio(self):
+        """Whether few of the objects they sent us were new to us"""
+        received = self.request_window.delivered.total
+        return received >= 50 and self.objects_new / received < shared.min_useful_ratio
+
+    def _want_vectors(self, to_get):
+        if shared.replicate_from:
+            # Followers get objects from the replication primary
+            return
+        room = 0 if shared.memory_pressure else max(shared.max_vectors_to_get - len(self.vectors_to_get), 0)
+        if len(to_get) > room:
+            logging.debug('Ignoring {} vectors from {}:{}, limit reached'.format(len(to_get) - room, self.host_print, self.port))
+            to_get = set(itertools.islice(to_get, room))
+        self.vectors_to_get.update(to_get)
+
+    @staticmethod
+    def _advertise_address(addr):
+        try:
+            shared.address_advertise_queue.put_nowait(addr)
+        except queue.Full:
+            logging.debug('Address advertise queue is full, dropping {}'.format(addr))
+
+    def _check_requests(self, now):
+        """Re-requests timed out objects and drops known ones, takes a pass over all vectors"""
+        if self.vectors_to_get:
+            # Our vectors are checked against the store, not all objects against our vectors
+            self.vectors_to_get = {vector for vector in self.vectors_to_get if vector not in shared.objects}
         if self.vectors_requested:
-            self.vectors_requested = {vector: t for vector, t in self.vectors_requested.items() if vector not in shared.objects and t > time.time() - 15 * 60}
-            to_re_request = {vector for vector, t in self.vectors_requested.items() if t < time.time() - 10 * 60}
-            if to_re_request:
+            timeout = self.request_window.timeout()
+            timed_out = []
+            for vector, t in list(self.vectors_requested.items()):
+                if vector in shared.objects:
+                    del self.vectors_requested[vector]
+                elif t < now - timeout:
+                    del self.vectors_requested[vector]
+                    timed_out.append(vector)
+            if timed_out:
+                self.request_window.on_timeout()
+                # Every object is requested again once, then we give up
+                to_re_request = [vector for vector in timed_out if vector not in self.vectors_retried]
+                self.vectors_retried.difference_update(timed_out)
+                self.vectors_retried.update(to_re_request)
                 self.vectors_to_get.update(to_re_request)
-                logging.debug('Re-requesting {} objects from {}:{}'.format(len(to_re_request), self.host_print, self.port))
+                logging.debug('Re-requesting {} objects from {}:{}, {}'.format(
+                    len(to_re_request), self.host_print, self.port, self.request_window))
+
+    def _request_objects(self):
+        # Called on every wakeup of the loop, full passes are done once per request_check_interval
+        now = time.time()
+        if now - self.last_request_check >= shared.request_check_interval:
+            self.last_request_check = now
+            self._check_requests(now)
+        room = min(self.request_window.room(len(self.vectors_requested)), shared.max_getdata_batch)
+        if admission.overloaded():
+            # Requests of useful peers are slowed down, of the others put off
+            room = 0 if self.low_ratio() else min(room, shared.overload_getdata_batch)
+        elif self.vectors_deferred:
+            deferred, self.vectors_deferred = self.vectors_deferred, set()
+            self._process_inv(deferred)
+        if self.vectors_to_get and room:
+            pack = set(itertools.islice(self.vectors_to_get, room))
+            self.vectors_to_get.difference_update(pack)
+            pack = {vector for vector in pack if vector not in shared.objects}
+            if pack:
+                self.send_queue.put(message.GetData(pack))
+                tracer.record(pack, 'getdata_sent', self)
+                now = time.time()
+                for vector in pack:
+                    self.vectors_requested[vector] = now
 
     def _send_objects(self):
-        if self.vectors_to_send:
-            if len(self.vectors_to_send) > 16:
-                to_send = random.sample(self.vectors_to_send, 16)
-                self.vectors_to_send.difference_update(to_send)
-            else:
-                to_send = self.vectors_to_send.copy()
-                self.vectors_to_send.clear()
-            with shared.objects_lock:
-                for vector in to_send:
-                    obj = shared.objects.get(vector, None)
-                    if obj:
-                        self.send_queue.put(message.Message(b'object', obj.to_bytes()))
+        """Queues requested objects in order of requests while less than send_budget bytes wait to be sent"""
+        while self.vectors_to_send and self.send_backlog() < shared.send_budget:
+            vector = self.vectors_to_send.popleft()
+            obj = shared.objects.get(vector, None)
+            if obj:
+                m = message.framed_object(obj)
+                self.send_queue.put(m)
+                tracer.record((vector,), 'object_served', self)
+                self.objects_served.add()
+                self.bytes_served.add(len(m.data))
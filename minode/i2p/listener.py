@@ -49,14 +49,13 @@ class I2PListener(threading.Thread):
                 destination = self._receive_line().split()[0]
                 logging.info('Incoming I2P connection from: {}'.format(destination.decode()))
 
-                hosts = set()
-                for c in shared.connections.copy():
-                    hosts.add(c.host)
-                for d in shared.i2p_dialers.copy():
-                    hosts.add(d.destination)
-                if destination in hosts:
+                if shared.connections.has_host(destination) or \
+                        any(d.destination == destination for d in shared.i2p_dialers.copy()):
                     logging.debug('Rejecting duplicate I2P connection.')
                     self.s.close()
+                elif shared.connections.is_banned(destination):
+                    logging.debug('Rejecting I2P connection from a banned destination.')
+                    self.s.close()
                 else:
                     c = Connection(destination, 'i2p', self.s, 'i2p', True, destination)
                     c.start()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class Inventory(dict):
+    """
+    Object store mapping vectors to objects, indexed by object type.
+    Listeners are called with new objects, delete_listeners with vectors
+    and objects removed from the store.
+    """
+    def __init__(self, objects=None):
+        super().__init__()
+        self.types = {}
+        self.listeners = []
+        self.delete_listeners = []
+        self.lock = threading.Lock()
+        if objects:
+            self.update(objects)
+
+    def __reduce__(self):
+        # Saved as a plain dict, so object files do not depend on this class
+        return dict, (dict(self),)
+
+    def __setitem__(self, vector, obj):
+        with self.lock:
+            old = self.get(vector)
+            if old is not None:
+                self._unindex(vector, old)
+            super().__setitem__(vector, obj)
+            self.types.setdefault(obj.object_type, set()).add(vector)
+        if old is None:
+            for listener in tuple(self.listeners):
+                listener(obj)
+
+    def __delitem__(self, vector):
+        with self.lock:
+            obj = self[vector]
+            super().__delitem__(vector)
+            self._unindex(vector, obj)
+        for listener in tuple(self.delete_listeners):
+            listener(vector, obj)
+
+    def _unindex(self, vector, obj):
+        vectors = self.types.get(obj.object_type)
+        if vectors is not None:
+            vectors.discard(vector)
+            if not vectors:
+                del self.types[obj.object_type]
+
+    def pop(self, vector, *default):
+        if vector in self:
+            obj = self[vector]
+            del self[vector]
+            return obj
+        if default:
+            return default[0]
+        raise KeyError(vector)
+
+    def update(self, objects):
+        for vector, obj in objects.items():
+            self[vector] = obj
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self.types.clear()
+
+    def vectors_by_type(self, object_type):
+        with self.lock:
+            return set(self.types.get(object_type, ()))
+
+    def filter(self, object_type=None, expires_after=None, expires_before=None):
+        """Vectors of objects of given type expiring in given time range, all arguments are optional"""
+        if object_type is None:
+            vectors = list(self.keys())
+        else:
+            vectors = self.vectors_by_type(object_type)
+        result = []
+        for vector in vectors:
+            obj = self.get(vector)
+            if obj is None:
+                continue
+            if expires_after is not None and obj.expires_time < expires_after:
+                continue
+            if expires_before is not None and obj.expires_time > expires_before:
+                continue
+            result.append(vector)
+        return result
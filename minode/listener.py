@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
+import collections
 import logging
+import select
 import socket
 import threading
 
+import admission
 from connection import Connection
+import ratelimit
 import shared
 
 
 class Listener(threading.Thread):
+    # Shared by IPv4 and IPv6 listeners
+    accept_bucket = ratelimit.TokenBucket(0)
+    accepted = ratelimit.RateMeter()
+    rejected = collections.Counter()
+
     def __init__(self, host, port, family=socket.AF_INET):
         super().__init__(name='Listener')
         self.host = host
@@ -15,24 +24,61 @@ class Listener(threading.Thread):
         self.family = family
         self.s = socket.socket(self.family, socket.SOCK_STREAM)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if shared.workers > 1:
+            # Every worker process listens on the same port, the kernel spreads incoming connections
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.s.bind((self.host, self.port))
-        self.s.listen(1)
-        self.s.settimeout(1)
+        self.s.listen(shared.listen_backlog)
+        self.s.setblocking(False)
+        self.accept_bucket.set_rate(shared.accept_rate, 2 * shared.accept_rate)
+
+    @classmethod
+    def stats(cls):
+        s = {'accepted': cls.accepted.total, 'accepted_per_second': round(cls.accepted.rate(), 2)}
+        s.update(('rejected_' + reason, count) for reason, count in cls.rejected.items())
+        return s
 
     def run(self):
         while True:
             if shared.shutting_down:
                 logging.debug('Shutting down Listener')
                 break
+            r, _, _ = select.select([self.s], [], [], 1)
+            if r:
+                self._accept_all()
+
+    def _accept_all(self):
+        """Accepts all pending connections, limits are checked before a Connection is created"""
+        while True:
             try:
                 conn, addr = self.s.accept()
-                logging.info('Incoming connection from: {}:{}'.format(addr[0], addr[1]))
-                with shared.connections_lock:
-                    if len(shared.connections) > shared.connection_limit:
-                        conn.close()
-                    else:
-                        c = Connection(addr[0], addr[1], conn, 'ip', True)
-                        c.start()
-                        shared.connections.add(c)
-            except socket.timeout:
-                pass
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.warning('Error while accepting connection: {}'.format(e))
+                break
+            reason = None
+            if shared.connections.is_banned(addr[0]):
+                reason = 'banned'
+            elif admission.overloaded():
+                reason = 'overload'
+            elif not ratelimit.allowance(1, self.accept_bucket):
+                reason = 'rate'
+            elif len(shared.connections) > shared.connection_limit:
+                reason = 'connection_limit'
+            elif shared.connections.count_host(addr[0]) >= shared.max_connections_per_ip:
+                reason = 'per_ip'
+            elif shared.connections.count_subnet(addr[0]) >= shared.max_connections_per_subnet:
+                reason = 'per_subnet'
+            if reason:
+                self.rejected[reason] += 1
+                logging.debug('Rejecting incoming connection from {}:{}, reason: {}'.format(addr[0], addr[1], reason))
+                conn.close()
+                continue
+
+            self.accept_bucket.consume(1)
+            self.accepted.add()
+            logging.info('Incoming connection from: {}:{}'.format(addr[0], addr[1]))
+            c = Connection(addr[0], addr[1], conn, 'ip', True)
+            c.start()
+            shared.connections.add(c)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+import time
+
+from scheduler import Histogram
+
+
+class LockHistogram(Histogram):
+    bounds = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1)
+
+
+class InstrumentedLock(object):
+    """
+    Lock recording how long threads wait for it and hold it,
+    separately for each place in the code acquiring it
+    """
+    def __init__(self, name, reentrant=False):
+        self.name = name
+        self.lock = threading.RLock() if reentrant else threading.Lock()
+        self.local = threading.local()
+        self.sites = {}
+        self.sites_lock = threading.Lock()
+
+    def __repr__(self):
+        return 'instrumented_lock {}'.format(self.name)
+
+    def __enter__(self):
+        self._acquire(sys._getframe(1), True, -1)
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(sys._getframe(1), blocking, timeout)
+
+    def _site(self, frame):
+        key = (frame.f_code.co_filename, frame.f_lineno)
+        site = self.sites.get(key)
+        if site is None:
+            with self.sites_lock:
+                site = self.sites.setdefault(key, (LockHistogram(), LockHistogram()))
+        return key, site
+
+    def _acquire(self, frame, blocking, timeout):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            now = time.perf_counter()
+            key, (wait, _) = self._site(frame)
+            wait.add(now - start)
+            held = getattr(self.local, 'held', None)
+            if held is None:
+                held = self.local.held = []
+            held.append((key, now))
+        return acquired
+
+    def release(self):
+        key, acquired_time = self.local.held.pop()
+        self.sites[key][1].add(time.perf_counter() - acquired_time)
+        self.lock.release()
+
+    def locked(self):
+        if hasattr(self.lock, 'locked'):
+            return self.lock.locked()
+        # RLock before Python 3.14
+        if self.lock.acquire(False):
+            self.lock.release()
+            return False
+        return True
+
+    def stats(self):
+        """Wait and hold times by call site, the longest waits first"""
+        with self.sites_lock:
+            sites = list(self.sites.items())
+        sites.sort(key=lambda item: item[1][0].total, reverse=True)
+        return [{'site': '{}:{}'.format(os.path.basename(filename), line),
+                 'wait': wait.to_dict(), 'hold': hold.to_dict()}
+                for (filename, line), (wait, hold) in sites]
@@ -10,16 +10,27 @@ import signal
 import socket
 
 from advertiser import Advertiser
+from admin import AdminServer
+from api import APIServer
 from manager import Manager
 from listener import Listener
+import admission
+import bootstrap
 import i2p.controller
 import i2p.listener
+import inventory
+import profiler
+import replication
+import ratelimit
 import shared
+import snapshot
+import workers
 
 
 def handler(s, f):
     logging.info('Gracefully shutting down MiNode')
     shared.shutting_down = True
+    shared.shutdown_event.set()
 
 
 def parse_arguments():
@@ -33,11 +44,33 @@ def parse_arguments():
     parser.add_argument('--no-ip', help='Do not use IP network', action='store_true')
     parser.add_argument('--trusted-peer', help='Specify a trusted peer we should connect to')
     parser.add_argument('--connection-limit', help='Maximum number of connections', type=int)
+    parser.add_argument('--listen-backlog', help='Length of queue of pending incoming connections', type=int)
+    parser.add_argument('--accept-rate', help='Maximum incoming connections accepted per second', type=int)
+    parser.add_argument('--max-connections-per-ip', help='Maximum connections from one IP address', type=int)
+    parser.add_argument('--max-connections-per-subnet', help='Maximum connections from one /24 (IPv4) or /48 (IPv6) subnet', type=int)
     parser.add_argument('--i2p', help='Enable I2P support (uses SAMv3)', action='store_true')
     parser.add_argument('--i2p-tunnel-length', help='Length of I2P tunnels', type=int)
     parser.add_argument('--i2p-sam-host', help='Host of I2P SAMv3 bridge')
     parser.add_argument('--i2p-sam-port', help='Port of I2P SAMv3 bridge', type=int)
     parser.add_argument('--i2p-transient', help='Generate new I2P destination on start', action='store_true')
+    parser.add_argument('--upload-limit', help='Global upload limit in kB/s', type=int)
+    parser.add_argument('--download-limit', help='Global download limit in kB/s', type=int)
+    parser.add_argument('--peer-upload-limit', help='Upload limit per connection in kB/s', type=int)
+    parser.add_argument('--peer-download-limit', help='Download limit per connection in kB/s', type=int)
+    parser.add_argument('--memory-limit', help='Memory held by connections and queues in MB', type=int)
+    parser.add_argument('--no-reconciliation', help='Always send full inventory to new connections', action='store_true')
+    parser.add_argument('--no-admission-control', help='Do not shed load when validation can not keep up', action='store_true')
+    parser.add_argument('--api', help='Enable local client API on a Unix socket in data directory', action='store_true')
+    parser.add_argument('--admin', help='Enable admin socket in data directory for changing settings at runtime', action='store_true')
+    parser.add_argument('--export-objects', help='Save objects to a snapshot file and exit', metavar='FILE')
+    parser.add_argument('--import-objects', help='Add objects from a snapshot or PyBitmessage messages.dat file and exit', metavar='FILE')
+    parser.add_argument('--trace', help='Measure time objects spend at each stage', action='store_true')
+    parser.add_argument('--trace-sample-rate', help='Fraction of objects whose traces are written to trace.log', type=float)
+    parser.add_argument('--capture', help='Record received messages of every connection to files in this directory', metavar='DIR')
+    parser.add_argument('--replication-listen', help='Serve the object store to followers on this address', metavar='HOST:PORT')
+    parser.add_argument('--replicate-from', help='Follow the object store of a primary node at this address', metavar='HOST:PORT')
+    parser.add_argument('--replication-key', help='File with the key shared by a primary and its followers, replication.key in data directory by default', metavar='FILE')
+    parser.add_argument('--workers', help='Number of worker processes sharing the listening port, each one keeps all objects in memory', type=int)
 
     args = parser.parse_args()
     if args.port:
@@ -75,6 +108,14 @@ def parse_arguments():
                 shared.trusted_peer = (addr[0], int(addr[1]))
     if args.connection_limit:
         shared.connection_limit = args.connection_limit
+    if args.listen_backlog:
+        shared.listen_backlog = args.listen_backlog
+    if args.accept_rate:
+        shared.accept_rate = args.accept_rate
+    if args.max_connections_per_ip:
+        shared.max_connections_per_ip = args.max_connections_per_ip
+    if args.max_connections_per_subnet:
+        shared.max_connections_per_subnet = args.max_connections_per_subnet
     if args.i2p:
         shared.i2p_enabled = True
     if args.i2p_tunnel_length:
@@ -85,12 +126,53 @@ def parse_arguments():
         shared.i2p_sam_port = args.i2p_sam_port
     if args.i2p_transient:
         shared.i2p_transient = True
+    if args.upload_limit:
+        shared.upload_limit = args.upload_limit * 1024
+    if args.download_limit:
+        shared.download_limit = args.download_limit * 1024
+    if args.peer_upload_limit:
+        shared.peer_upload_limit = args.peer_upload_limit * 1024
+    if args.peer_download_limit:
+        shared.peer_download_limit = args.peer_download_limit * 1024
+    if args.memory_limit:
+        shared.memory_limit = args.memory_limit * 1024 * 1024
+    if args.no_reconciliation:
+        shared.services &= ~shared.service_reconciliation
+    if args.no_admission_control:
+        shared.admission_control = False
+    if args.api:
+        shared.api_enabled = True
+    if args.admin:
+        shared.admin_enabled = True
+    if args.export_objects:
+        shared.export_objects_file = args.export_objects
+    if args.import_objects:
+        shared.import_objects_file = args.import_objects
+    if args.trace:
+        shared.trace_enabled = True
+    if args.trace_sample_rate is not None:
+        shared.trace_sample_rate = args.trace_sample_rate
+    if args.capture:
+        os.makedirs(args.capture, exist_ok=True)
+        shared.capture_directory = args.capture
+    if args.replication_listen:
+        shared.replication_listen = replication.parse_address(args.replication_listen, 8445)
+    if args.replicate_from:
+        shared.replicate_from = replication.parse_address(args.replicate_from, 8445)
+    if args.replication_key:
+        shared.replication_key_file = args.replication_key
+    if args.workers:
+        if args.replication_listen or args.replicate_from:
+            parser.error('--workers can not be used together with replication')
+        if args.i2p:
+            parser.error('--workers can not be used together with --i2p')
+        shared.workers = args.workers
 
 
 def load_data():
     try:
         with open(shared.data_directory + 'objects.pickle', mode='br') as file:
-            shared.objects = pickle.load(file)
+            shared.objects = inventory.Inventory(pickle.load(file))
     except Exception as e:
         logging.warning('Error while loading objects from disk.')
         logging.warning(e)
@@ -109,6 +191,15 @@ def load_data():
         logging.warning('Error while loading nodes from disk.')
         logging.warning(e)
 
+    try:
+        with open(shared.data_directory + 'node_scores.pickle', mode='br') as file:
+            shared.node_scores = pickle.load(file)
+    except Exception as e:
+        logging.warning('Error while loading node scores from disk.')
+        logging.warning(e)
+
+    bootstrap.load_warm_peers()
+
     with open(os.path.join(shared.source_directory, 'core_nodes.csv'), mode='r', newline='') as f:
         reader = csv.reader(f)
         shared.core_nodes = {tuple(row) for row in reader}
@@ -120,19 +211,6 @@ def load_data():
         shared.i2p_node_pool.update(shared.i2p_core_nodes)
 
 
-def bootstrap_from_dns():
-    try:
-        for item in socket.getaddrinfo('bootstrap8080.bitmessage.org', 80):
-            shared.unchecked_node_pool.add((item[4][0], 8080))
-            logging.debug('Adding ' + item[4][0] + ' to unchecked_node_pool based on DNS bootstrap method')
-        for item in socket.getaddrinfo('bootstrap8444.bitmessage.org', 80):
-            shared.unchecked_node_pool.add((item[4][0], 8444))
-            logging.debug('Adding ' + item[4][0] + ' to unchecked_node_pool based on DNS bootstrap method')
-    except Exception as e:
-        logging.error('Error during DNS bootstrap')
-        logging.error(e)
-
-
 def start_ip_listener():
     listener_ipv4 = None
     listener_ipv6 = None
@@ -160,9 +238,9 @@ def start_ip_listener():
 
 def start_i2p_listener():
     # Grab I2P destinations from old object file
-    for obj in shared.objects.values():
-        if obj.object_type == shared.i2p_dest_obj_type:
-            shared.i2p_unchecked_node_pool.add((base64.b64encode(obj.object_payload, altchars=b'-~'), 'i2p'))
+    for vector in shared.objects.vectors_by_type(shared.i2p_dest_obj_type):
+        obj = shared.objects[vector]
+        shared.i2p_unchecked_node_pool.add((base64.b64encode(obj.object_payload, altchars=b'-~'), 'i2p'))
 
     dest_priv = b''
 
@@ -207,12 +285,64 @@ def start_i2p_listener():
         logging.warning(e)
 
 
+def start_services():
+    # Started first to see all connections being established
+    bootstrapper = bootstrap.Bootstrapper()
+    bootstrapper.start()
+
+    if shared.admission_control:
+        admission.Monitor().start()
+
+    manager = Manager()
+    manager.start()
+
+    advertiser = Advertiser()
+    advertiser.start()
+
+    if shared.listen_for_connections:
+        start_ip_listener()
+
+    if shared.api_enabled and not shared.worker_id:
+        api_server = APIServer(shared.data_directory + 'api.sock')
+        api_server.start()
+
+    if shared.replication_listen:
+        host, port = shared.replication_listen
+        replication.ReplicationServer(host, port, replication.load_key()).start()
+
+    if shared.replicate_from:
+        host, port = shared.replicate_from
+        replication.ReplicationFollower(host, port, replication.load_key()).start()
+
+    if shared.admin_enabled and not shared.worker_id:
+        admin_server = AdminServer(shared.data_directory + 'admin.sock', manager.scheduler)
+        admin_server.start()
+
+
+def run_snapshot_commands():
+    try:
+        if shared.import_objects_file:
+            snapshot.import_objects(shared.import_objects_file)
+            Manager.pickle_objects()
+        if shared.export_objects_file:
+            count = snapshot.export_objects(shared.export_objects_file)
+            logging.info('Exported {} objects'.format(count))
+    except Exception as e:
+        logging.error('Error while processing object snapshot')
+        logging.error(e)
+
+
 def main():
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGTERM, handler)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.signal_handler)
 
     parse_arguments()
 
+    ratelimit.upload.set_rate(shared.upload_limit)
+    ratelimit.download.set_rate(shared.download_limit)
+
     logging.basicConfig(level=shared.log_level, format='[%(asctime)s] [%(levelname)s] %(message)s')
     logging.info('Starting MiNode')
 
@@ -226,8 +356,9 @@ def main():
 
     load_data()
 
-    if shared.ip_enabled and not shared.trusted_peer:
-        bootstrap_from_dns()
+    if shared.export_objects_file or shared.import_objects_file:
+        run_snapshot_commands()
+        return
 
     if shared.i2p_enabled:
         # We are starting it before cleaning expired objects so we can collect I2P destination objects
@@ -239,16 +370,14 @@ def main():
                 logging.debug('Deleted expired object: {}'.format(base64.b16encode(vector).decode()))
             else:
                 logging.warning('Deleted invalid object: {}'.format(base64.b16encode(vector).decode()))
+            shared.tombstones.add(vector, len(shared.objects[vector].to_bytes()))
             del shared.objects[vector]
 
-    manager = Manager()
-    manager.start()
-
-    advertiser = Advertiser()
-    advertiser.start()
-
-    if shared.listen_for_connections:
-        start_ip_listener()
+    if shared.workers > 1:
+        coordinator = workers.Coordinator()
+        coordinator.start()
+    else:
+        start_services()
 
 
 if __name__ == '__main__':
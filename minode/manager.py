@@ -7,67 +7,75 @@ import random
 import threading
 import time
 
-from connection import Connection
+import admission
+import bootstrap
+from connection import Connection, VECTOR_ENTRY_SIZE
 from i2p.dialer import I2PDialer
+from listener import Listener
+import message
 import pow
+from scheduler import Scheduler
+import scoring
 import shared
 import structure
+import tracer
+import workers
 
 
 class Manager(threading.Thread):
     def __init__(self):
         super().__init__(name='Manager')
         self.q = queue.Queue()
-        self.last_cleaned_objects = time.time()
-        self.last_cleaned_connections = time.time()
-        self.last_pickled_objects = time.time()
-        self.last_pickled_nodes = time.time()
-        self.last_published_i2p_destination = time.time() - 50 * 60 + random.uniform(-1, 1) * 300  # Publish destination 5-15 minutes after start
+        self.scheduler = Scheduler('Manager')
+        self.scheduler.add('clean_objects', self.clean_objects, 90, heavy=True)
+        self.scheduler.add('manage_connections', self.manage_connections, 2, delay=0)
+        self.scheduler.add('manage_memory', self.manage_memory, 5)
+        self.scheduler.add('log_connection_stats', self.log_connection_stats, 60)
+        self.scheduler.add('log_job_stats', self.log_job_stats, 60)
+        if shared.trace_enabled:
+            self.scheduler.add('flush_traces', tracer.tracer.flush, 10)
+            self.scheduler.add('log_trace_stats', tracer.tracer.log_stats, 60)
+        self.scheduler.add('rotate_outgoing', self.rotate_outgoing, lambda: shared.rotation_interval)
+        self.scheduler.add('pickle_objects', self.pickle_objects, 100, heavy=True)
+        self.scheduler.add('pickle_nodes', self.pickle_nodes, 60, heavy=True)
+        # Publish destination 5-15 minutes after start
+        self.scheduler.add('publish_i2p_destination', self.publish_i2p_destination, 3600, delay=random.uniform(5, 15) * 60)
 
     def run(self):
-        while True:
-            time.sleep(0.8)
-            now = time.time()
-            if shared.shutting_down:
-                logging.debug('Shutting down Manager')
-                break
-            if now - self.last_cleaned_objects > 90:
-                self.clean_objects()
-                self.last_cleaned_objects = now
-            if now - self.last_cleaned_connections > 2:
-                self.manage_connections()
-                self.last_cleaned_connections = now
-            if now - self.last_pickled_objects > 100:
-                self.pickle_objects()
-                self.last_pickled_objects = now
-            if now - self.last_pickled_nodes > 60:
-                self.pickle_nodes()
-                self.last_pickled_nodes = now
-            if now - self.last_published_i2p_destination > 3600:
-                self.publish_i2p_destination()
-                self.last_published_i2p_destination = now
+        self.scheduler.run(shared.shutdown_event)
+        # Scores of peers connected at shutdown are kept for the next start
+        for c in shared.connections.select(server=False):
+            scoring.record(c)
+        self.pickle_nodes()
+        if shared.trace_enabled:
+            tracer.tracer.flush(everything=True)
+            tracer.tracer.log_stats()
+        logging.debug('Shutting down Manager')
+
+    def log_job_stats(self):
+        for job in self.scheduler.jobs:
+            logging.debug('Maintenance {}'.format(job))
 
     @staticmethod
     def clean_objects():
         for vector in set(shared.objects):
-            if shared.objects[vector].is_expired():
+            obj = shared.objects[vector]
+            if obj.is_expired():
                 with shared.objects_lock:
                     del shared.objects[vector]
+                shared.tombstones.add(vector, len(obj.to_bytes()))
                 logging.debug('Deleted expired object: {}'.format(base64.b16encode(vector).decode()))
 
     @staticmethod
     def manage_connections():
-        hosts = set()
-        outgoing_connections = 0
-        for c in shared.connections.copy():
-            if not c.is_alive() or c.status == 'disconnected':
-                with shared.connections_lock:
-                    shared.connections.remove(c)
-            else:
-                hosts.add(c.host)
+        for c in shared.connections.select('disconnected') + shared.connections.select('failed'):
+            if not c.is_alive():
+                shared.connections.remove(c)
                 if not c.server:
-                    outgoing_connections += 1
+                    scoring.record(c)
+        outgoing_connections = shared.connections.count_outgoing()
 
+        hosts = set()
         for d in shared.i2p_dialers.copy():
             hosts.add(d.destination)
             if not d.is_alive():
@@ -77,7 +85,12 @@ class Manager(threading.Thread):
         if shared.trusted_peer:
             to_connect.add(shared.trusted_peer)
 
-        if outgoing_connections < shared.outgoing_connections and shared.send_outgoing_connections and not shared.trusted_peer:
+        if shared.warm_peers and shared.send_outgoing_connections and not shared.trusted_peer:
+            # Peers from the last run are dialed all at once before any others
+            to_connect.update(shared.warm_peers)
+            shared.warm_peers = ()
+
+        elif outgoing_connections < shared.outgoing_connections and shared.send_outgoing_connections and not shared.trusted_peer:
 
             if shared.ip_enabled:
                 if len(shared.unchecked_node_pool) > 16:
@@ -85,10 +98,10 @@ class Manager(threading.Thread):
                 else:
                     to_connect.update(shared.unchecked_node_pool)
                 shared.unchecked_node_pool.difference_update(to_connect)
-                if len(shared.node_pool) > 8:
-                    to_connect.update(random.sample(shared.node_pool, 8))
+                if len(shared.node_pool) > 32:
+                    to_connect.update(scoring.best(random.sample(shared.node_pool, 32), 8))
                 else:
-                    to_connect.update(shared.node_pool)
+                    to_connect.update(scoring.best(shared.node_pool, 8))
 
             if shared.i2p_enabled:
                 if len(shared.i2p_unchecked_node_pool) > 16:
@@ -96,13 +109,14 @@ class Manager(threading.Thread):
                 else:
                     to_connect.update(shared.i2p_unchecked_node_pool)
                 shared.i2p_unchecked_node_pool.difference_update(to_connect)
-                if len(shared.i2p_node_pool) > 8:
-                    to_connect.update(random.sample(shared.i2p_node_pool, 8))
+                if len(shared.i2p_node_pool) > 32:
+                    to_connect.update(scoring.best(random.sample(shared.i2p_node_pool, 32), 8))
                 else:
-                    to_connect.update(shared.i2p_node_pool)
+                    to_connect.update(scoring.best(shared.i2p_node_pool, 8))
 
         for addr in to_connect:
-            if addr[0] in hosts:
+            if addr[0] in hosts or shared.connections.has_host(addr[0]) or shared.connections.is_banned(addr[0]) \
+                    or not workers.owns(addr[0]):
                 continue
             if addr[1] == 'i2p' and shared.i2p_enabled:
                 if shared.i2p_session_nick and addr[0] != shared.i2p_dest_pub:
@@ -119,13 +133,53 @@ class Manager(threading.Thread):
             else:
                 c = Connection(addr[0], addr[1])
                 c.start()
-                hosts.add(c.host)
-                with shared.connections_lock:
-                    shared.connections.add(c)
-        shared.hosts = hosts
+                shared.connections.add(c)
+
+    @staticmethod
+    def rotate_outgoing():
+        """Drops the worst outgoing connection, manage_connections replaces it with a new one"""
+        if shared.trusted_peer:
+            return
+        outgoing = [c for c in shared.connections.select('fully_established', server=False)
+                    if time.time() - c.established_time > shared.rotation_min_age]
+        if len(outgoing) < shared.outgoing_connections:
+            return
+        worst = min(outgoing, key=lambda c: c.score())
+        logging.info('Replacing outgoing connection to {}:{} with score {:.2f}'.format(
+            worst.host_print, worst.port, worst.score()))
+        worst.status = 'disconnecting'
+
+    @staticmethod
+    def manage_memory():
+        usage = {c: c.memory_usage() for c in shared.connections.copy() if c.status != 'disconnected'}
+        total = sum(usage.values())
+        total += VECTOR_ENTRY_SIZE * shared.vector_advertise_queue.qsize()
+        total += 200 * shared.address_advertise_queue.qsize()
+        shared.memory_pressure = total > shared.memory_limit
+        if shared.memory_pressure:
+            logging.warning('Memory limit reached, {} bytes held by {} connections'.format(total, len(usage)))
+            if usage:
+                worst = max(usage, key=usage.get)
+                logging.warning('Disconnecting from {}:{} which holds {} bytes'.format(worst.host_print, worst.port, usage[worst]))
+                worst.status = 'disconnecting'
+
+    @staticmethod
+    def log_connection_stats():
+        cache = message.object_cache
+        logging.debug('Object message cache: {} entries, {} bytes, {} hits, {} misses'.format(
+            len(cache.entries), cache.size, cache.hits, cache.misses))
+        logging.debug('Tombstones: {}'.format(', '.join('{}: {}'.format(k, v) for k, v in shared.tombstones.stats().items())))
+        logging.debug('Admission control: {}'.format(', '.join('{}: {}'.format(k, v) for k, v in admission.control.stats().items())))
+        logging.debug('Listener: {}'.format(', '.join('{}: {}'.format(k, v) for k, v in Listener.stats().items())))
+        for c in shared.connections.select('fully_established'):
+            logging.debug('Stats for {}:{}: {}'.format(
+                c.host_print, c.port, ', '.join('{}: {}'.format(k, v) for k, v in c.stats().items())))
 
     @staticmethod
     def pickle_objects():
+        if shared.worker_id:
+            # Every worker holds all objects, the first one saves them
+            return
         try:
             with open(shared.data_directory + 'objects.pickle', mode='bw') as file:
                 with shared.objects_lock:
@@ -137,6 +191,8 @@ class Manager(threading.Thread):
 
     @staticmethod
     def pickle_nodes():
+        if shared.worker_id:
+            return
         if len(shared.node_pool) > 10000:
             shared.node_pool = set(random.sample(shared.node_pool, 10000))
         if len(shared.unchecked_node_pool) > 1000:
@@ -146,12 +202,17 @@ class Manager(threading.Thread):
             shared.i2p_node_pool = set(random.sample(shared.i2p_node_pool, 1000))
         if len(shared.i2p_unchecked_node_pool) > 100:
             shared.i2p_unchecked_node_pool = set(random.sample(shared.i2p_unchecked_node_pool, 100))
+        bootstrap.save_warm_peers()
+        shared.node_scores = {addr: score for addr, score in shared.node_scores.items()
+                              if addr in shared.node_pool or addr in shared.i2p_node_pool}
 
         try:
             with open(shared.data_directory + 'nodes.pickle', mode='bw') as file:
                 pickle.dump(shared.node_pool, file, protocol=3)
             with open(shared.data_directory + 'i2p_nodes.pickle', mode='bw') as file:
                 pickle.dump(shared.i2p_node_pool, file, protocol=3)
+            with open(shared.data_directory + 'node_scores.pickle', mode='bw') as file:
+                pickle.dump(shared.node_scores, file, protocol=3)
                 logging.debug('Saved nodes')
         except Exception as e:
             logging.warning('Error while saving nodes')
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import base64
+import collections
 import hashlib
 import struct
+import threading
 import time
 
+import reconciliation
 import shared
 import structure
 
@@ -39,12 +42,16 @@ class Header(object):
 
 
 class Message(object):
-    def __init__(self, command, payload):
+    def __init__(self, command, payload, payload_hash=None, pow_initial_hash=None):
         self.command = command
         self.payload = payload
 
         self.payload_length = len(payload)
-        self.payload_checksum = hashlib.sha512(payload).digest()[:4]
+        # SHA-512 of the payload, its start is the checksum and for objects it is the inner hash of the vector
+        self.payload_hash = payload_hash or hashlib.sha512(payload).digest()
+        self.payload_checksum = self.payload_hash[:4]
+        # Of object messages hashed while being received, see PayloadHasher
+        self.pow_initial_hash = pow_initial_hash
 
     def __repr__(self):
         return '{}, payload_length: {}, payload_checksum: {}'\
@@ -56,7 +63,8 @@ class Message(object):
         return b
 
     @classmethod
-    def from_bytes(cls, b):
+    def from_bytes(cls, b, payload_hash=None, pow_initial_hash=None):
+        """Hashes of the payload are computed unless given"""
         h = Header.from_bytes(b[:24])
 
         payload = b[24:]
@@ -65,22 +73,148 @@ class Message(object):
         if payload_length != h.payload_length:
             raise ValueError('wrong payload length, expected {}, got {}'.format(h.payload_length, payload_length))
 
-        payload_checksum = hashlib.sha512(payload).digest()[:4]
+        if payload_hash is None:
+            payload_hash = hashlib.sha512(payload).digest()
+        payload_checksum = payload_hash[:4]
 
         if payload_checksum != h.payload_checksum:
             raise ValueError('wrong payload checksum, expected {}, got {}'.format(h.payload_checksum, payload_checksum))
 
-        return cls(h.command, payload)
+        return cls(h.command, payload, payload_hash, pow_initial_hash)
+
+
+class PayloadHasher(object):
+    """
+    Hashes payloads of messages in a receive buffer as their chunks arrive,
+    so that checksums, vectors and PoW initial hashes (of object bytes after
+    the nonce) are ready when the last byte lands. It runs ahead of message
+    processing, which takes results in order and reports consumed bytes.
+    """
+    def __init__(self):
+        # Positions in the buffer: start of the message being hashed, its payload and end, hashed bytes
+        self.position = 0
+        self.payload_start = None
+        self.payload_end = None
+        self.hashed = 0
+        self.payload_hash = None
+        self.pow_hash = None
+        self.broken = False
+        # (payload hash, PoW initial hash or None) of complete messages
+        self.results = collections.deque()
+
+    def update(self, buffer):
+        while not self.broken:
+            if self.payload_end is None:
+                if len(buffer) < self.position + shared.header_length:
+                    return
+                try:
+                    h = Header.from_bytes(buffer[self.position:self.position + shared.header_length])
+                except ValueError:
+                    # Left for message processing to report
+                    self.broken = True
+                    return
+                self.payload_start = self.hashed = self.position + shared.header_length
+                self.payload_end = self.payload_start + h.payload_length
+                self.payload_hash = hashlib.sha512()
+                self.pow_hash = hashlib.sha512() if h.command == b'object' else None
+            end = min(len(buffer), self.payload_end)
+            if end > self.hashed:
+                view = memoryview(buffer)
+                self.payload_hash.update(view[self.hashed:end])
+                if self.pow_hash:
+                    start = max(self.hashed, self.payload_start + 8)
+                    if end > start:
+                        self.pow_hash.update(view[start:end])
+                view.release()
+                self.hashed = end
+            if end < self.payload_end:
+                return
+            self.results.append((self.payload_hash.digest(), self.pow_hash.digest() if self.pow_hash else None))
+            self.position = self.payload_end
+            self.payload_end = None
+
+    def pop(self):
+        """Hashes of the next complete message, (None, None) if not known"""
+        if self.results:
+            return self.results.popleft()
+        return None, None
+
+    def consume(self, size):
+        """Processing removed size bytes from the start of the buffer"""
+        self.position -= size
+        self.hashed -= size
+        if self.payload_end is not None:
+            self.payload_start -= size
+            self.payload_end -= size
+
+
+class FramedMessage(object):
+    """Complete encoded message, it is encoded once and shared by all connections sending it"""
+    def __init__(self, command, data, description=None):
+        self.command = command
+        self.data = data
+        self.payload_length = len(data) - shared.header_length
+        self.description = description
+        # Vectors of an inv, set when tracing
+        self.vectors = None
+
+    def __repr__(self):
+        return self.description or '{}, payload_length: {}'.format(self.command.decode(), self.payload_length)
+
+    def to_bytes(self):
+        return self.data
+
+    @classmethod
+    def encode(cls, m, description=None):
+        data = m.to_bytes()
+        return cls(data[4:16].rstrip(b'\x00'), data, description or repr(m))
+
+
+class FramedCache(object):
+    """LRU cache of framed messages limited by their total size in bytes"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self.lock:
+            m = self.entries.get(key)
+            if m is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return m
+            self.misses += 1
+        m = build()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = m
+                self.size += len(m.data)
+            while self.size > self.max_size and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+        return m
+
+
+object_cache = FramedCache(shared.framed_cache_size)
+
+
+def framed_object(obj):
+    return object_cache.get(obj.vector, lambda: FramedMessage.encode(Message(b'object', obj.to_bytes()), repr(obj)))
 
 
 class Version(object):
-    def __init__(self, host, port, protocol_version=shared.protocol_version, services=shared.services,
+    def __init__(self, host, port, protocol_version=shared.protocol_version, services=None,
                  nonce=shared.nonce, user_agent=shared.user_agent):
         self.host = host
         self.port = port
 
         self.protocol_version = protocol_version
-        self.services = services
+        # Looked up on every call, services depend on command line arguments
+        self.services = shared.services if services is None else services
         self.nonce = nonce
         self.user_agent = user_agent
 
@@ -152,11 +286,9 @@ class Inv(object):
 
         payload = payload[vector_count_varint_length:]
 
-        vectors = set()
-
-        while payload:
-            vectors.add(payload[:32])
-            payload = payload[32:]
+        if len(payload) % 32:
+            raise ValueError('malformed Inv message, wrong payload length')
+        vectors = {payload[i:i + 32] for i in range(0, len(payload), 32)}
 
         if vector_count != len(vectors):
             raise ValueError('malformed Inv message, wrong vector_count')
@@ -166,7 +298,8 @@ class Inv(object):
 
 class GetData(object):
     def __init__(self, vectors):
-        self.vectors = set(vectors)
+        # Keeps order of vectors, requested objects are sent in that order
+        self.vectors = list(dict.fromkeys(vectors))
 
     def __repr__(self):
         return 'getdata, count: {}'.format(len(self.vectors))
@@ -183,16 +316,12 @@ class GetData(object):
 
         payload = payload[vector_count_varint_length:]
 
-        vectors = set()
-
-        while payload:
-            vectors.add(payload[:32])
-            payload = payload[32:]
+        getdata = cls(payload[i:i + 32] for i in range(0, len(payload), 32))
 
-        if vector_count != len(vectors):
+        if vector_count != len(getdata.vectors):
             raise ValueError('malformed GetData message, wrong vector_count')
 
-        return cls(vectors)
+        return getdata
 
 
 class Addr(object):
@@ -214,10 +343,54 @@ class Addr(object):
 
         payload = payload[addr_count_varint_length:]
 
-        addresses = set()
-
-        while payload:
-            addresses.add(structure.NetAddr.from_bytes(payload[:38]))
-            payload = payload[38:]
+        addresses = {structure.NetAddr.from_bytes(payload[i:i + 38]) for i in range(0, len(payload), 38)}
 
         return cls(addresses)
+
+
+class Sketch(object):
+    """MiNode extension, IBLT of the sender's unexpired vectors, see reconciliation.py"""
+    def __init__(self, set_size, iblt):
+        self.set_size = set_size
+        self.iblt = iblt
+        self.payload = None
+
+    def __repr__(self):
+        return 'sketch, set_size: {}, cells: {}'.format(self.set_size, self.iblt.cells)
+
+    def to_bytes(self):
+        if self.payload is None:
+            self.payload = structure.VarInt(self.set_size).to_bytes() + self.iblt.to_bytes()
+        return Message(b'sketch', self.payload).to_bytes()
+
+    @classmethod
+    def from_message(cls, m):
+        payload = m.payload
+
+        if not payload:
+            raise ValueError('malformed Sketch message, empty payload')
+        set_size_varint_length = structure.VarInt.length(payload[0])
+        # IBLT starts with the salt and the number of cells
+        if len(payload) < set_size_varint_length + 12:
+            raise ValueError('malformed Sketch message, wrong payload length')
+        set_size = structure.VarInt.from_bytes(payload[:set_size_varint_length]).n
+
+        return cls(set_size, reconciliation.IBLT.from_bytes(payload[set_size_varint_length:]))
+
+
+class SketchFail(object):
+    """MiNode extension, sketch could not be decoded, asks for one with given number of cells"""
+    def __init__(self, cells):
+        self.cells = cells
+
+    def __repr__(self):
+        return 'sketchfail, cells: {}'.format(self.cells)
+
+    def to_bytes(self):
+        return Message(b'sketchfail', structure.VarInt(self.cells).to_bytes()).to_bytes()
+
+    @classmethod
+    def from_message(cls, m):
+        if not m.payload or len(m.payload) != structure.VarInt.length(m.payload[0]):
+            raise ValueError('malformed SketchFail message, wrong payload length')
+        return cls(structure.VarInt.from_bytes(m.payload).n)
@@ -2,12 +2,14 @@ import base64
 import hashlib
 import logging
 import multiprocessing
+import queue
 import shared
 import struct
 import threading
 import time
 
 import structure
+import workers
 
 
 def _pow_worker(target, initial_hash, q):
@@ -38,7 +40,11 @@ def _worker(obj):
 
     with shared.objects_lock:
         shared.objects[obj.vector] = obj
-        shared.vector_advertise_queue.put(obj.vector)
+    workers.share_object(obj)
+    try:
+        shared.vector_advertise_queue.put_nowait(obj.vector)
+    except queue.Full:
+        logging.warning('Vector advertise queue is full, not advertising {}'.format(obj))
 
 
 def do_pow_and_publish(obj):
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler of all threads of a running node, started by SIGUSR1
+or the API. Stacks are written in the folded format of flamegraph.pl
+to the data directory.
+"""
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import shared
+
+
+def _folded(thread_name, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ';'.join(reversed(stack))
+
+
+class Profiler(threading.Thread):
+    lock = threading.Lock()
+    running = None
+
+    def __init__(self, duration, interval):
+        super().__init__(name='Profiler', daemon=True)
+        self.duration = duration
+        self.interval = interval
+        self.path = shared.data_directory + 'profile-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S'))
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @classmethod
+    def start_profile(cls, duration=None, interval=None):
+        """Starts profiling unless already running, returns path of the output file"""
+        with cls.lock:
+            if cls.running and cls.running.is_alive():
+                return None
+            cls.running = cls(duration or shared.profile_duration, interval or shared.profile_interval)
+            cls.running.start()
+            return cls.running.path
+
+    def run(self):
+        logging.info('Profiling for {} seconds'.format(self.duration))
+        end = time.monotonic() + self.duration
+        while time.monotonic() < end and not shared.shutting_down:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != self.ident:
+                    self.stacks[_folded(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.write()
+
+    def write(self):
+        try:
+            with open(self.path, mode='w') as file:
+                for stack, count in self.stacks.most_common():
+                    file.write('{} {}\n'.format(stack, count))
+            with open(self.path[:-len('.folded')] + '-locks.json', mode='w') as file:
+                json.dump(lock_stats(), file, indent=2)
+            logging.info('Saved {} samples to {}'.format(self.samples, self.path))
+        except Exception as e:
+            logging.warning('Error while saving profile')
+            logging.warning(e)
+
+
+def lock_stats():
+    return {lock.name: lock.stats() for lock in (shared.objects_lock, shared.connections.lock)}
+
+
+def signal_handler(s, f):
+    Profiler.start_profile()
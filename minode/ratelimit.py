@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket refilled with `rate` tokens per second, rate of 0 means unlimited"""
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+    def __repr__(self):
+        return 'token_bucket, rate: {}, burst: {}, tokens: {}'.format(self.rate, self.burst, int(self.tokens))
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self._refill()
+            if not self.rate:
+                # Was unlimited, start with a full bucket
+                self.tokens = burst or rate
+            self.rate = rate
+            self.burst = burst or rate
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, self.burst)
+        self.last_refill = now
+
+    def available(self):
+        if not self.rate:
+            return float('inf')
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def consume(self, n):
+        """Takes n tokens, the bucket may go into debt which is paid off by later refills"""
+        if not self.rate:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+
+    def delay(self, n=1):
+        """Seconds until n tokens become available"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            self._refill()
+            return max(n - self.tokens, 0) / self.rate
+
+
+class RateMeter(object):
+    """Exponentially weighted rate of events per second, averaged over about `period` seconds"""
+    def __init__(self, period=10):
+        self.period = period
+        self.total = 0
+        self.value = 0.0
+        self.last_update = time.monotonic()
+
+    def _decay(self):
+        now = time.monotonic()
+        self.value *= math.exp(-(now - self.last_update) / self.period)
+        self.last_update = now
+
+    def add(self, n=1):
+        self._decay()
+        self.value += n / self.period
+        self.total += n
+
+    def rate(self):
+        self._decay()
+        return self.value
+
+
+def allowance(size, *buckets):
+    for b in buckets:
+        size = min(size, b.available())
+    return max(int(size), 0)
+
+
+def delay(n, *buckets):
+    """Seconds until n tokens become available in all buckets"""
+    return max(b.delay(n) for b in buckets)
+
+
+def consume(n, *buckets):
+    for b in buckets:
+        b.consume(n)
+
+
+upload = TokenBucket(0)
+download = TokenBucket(0)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Inventory set reconciliation between MiNode peers.
+
+Both peers send an invertible Bloom lookup table (IBLT) of their unexpired vectors instead of inv messages.
+Subtracting our own table from the received one and peeling it yields the vectors the peer has and we do not,
+so the cost of a reconnect depends on the size of the difference, not on the size of the inventory.
+If the table can not be decoded a bigger one is requested, when it would be bigger than inv messages
+with all vectors the sender falls back to the original inv flow.
+"""
+import hashlib
+import struct
+
+HASH_COUNT = 3
+CELL_SIZE = 4 + 32 + 4
+MAX_CELLS = 100000
+
+
+def inv_size(count):
+    """Bytes taken by inv messages announcing count vectors"""
+    return count * 32 + (count // 10000 + 1) * (24 + 3)
+
+
+def sketch_size(cells):
+    return 24 + 9 + 12 + cells * CELL_SIZE
+
+
+class IBLT(object):
+    """Invertible Bloom lookup table of 32 byte vectors"""
+    def __init__(self, cells, salt):
+        # Every hash function gets its own part of the table so a vector never hits one cell twice
+        self.cells = max(cells + (-cells) % HASH_COUNT, HASH_COUNT)
+        self.salt = salt
+        self.counts = [0] * self.cells
+        self.keys = [0] * self.cells
+        self.checks = [0] * self.cells
+
+    def __repr__(self):
+        return 'iblt, cells: {}'.format(self.cells)
+
+    def _hash(self, vector):
+        h = hashlib.blake2b(vector, digest_size=16, key=self.salt).digest()
+        part = self.cells // HASH_COUNT
+        indices = [int.from_bytes(h[4 * i:4 * i + 4], 'big') % part + i * part for i in range(HASH_COUNT)]
+        return indices, int.from_bytes(h[12:16], 'big')
+
+    def _insert(self, vector, count):
+        indices, check = self._hash(vector)
+        key = int.from_bytes(vector, 'big')
+        for i in indices:
+            self.counts[i] += count
+            self.keys[i] ^= key
+            self.checks[i] ^= check
+
+    def add(self, vector):
+        self._insert(vector, 1)
+
+    @classmethod
+    def from_vectors(cls, vectors, cells, salt):
+        t = cls(cells, salt)
+        for vector in vectors:
+            t._insert(vector, 1)
+        return t
+
+    def subtract(self, other):
+        if other.cells != self.cells or other.salt != self.salt:
+            raise ValueError('can not subtract different tables')
+        t = IBLT(self.cells, self.salt)
+        t.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        t.keys = [a ^ b for a, b in zip(self.keys, other.keys)]
+        t.checks = [a ^ b for a, b in zip(self.checks, other.checks)]
+        return t
+
+    def _pure(self, i):
+        if self.counts[i] not in (1, -1):
+            return False
+        return self._hash(self.keys[i].to_bytes(32, 'big'))[1] == self.checks[i]
+
+    def decode(self):
+        """
+        Peels the table in place, returns vectors counted positively (ours in a.subtract(b)),
+        vectors counted negatively and whether the whole table was decoded
+        """
+        positive = set()
+        negative = set()
+        peeled = set()
+        pure = [i for i in range(self.cells) if self._pure(i)]
+        while pure:
+            i = pure.pop()
+            if not self._pure(i):
+                continue
+            count = self.counts[i]
+            vector = self.keys[i].to_bytes(32, 'big')
+            if vector in peeled or len(peeled) >= self.cells:
+                # A crafted table can make a vector peel back and forth forever
+                return positive, negative, False
+            peeled.add(vector)
+            (positive if count == 1 else negative).add(vector)
+            self._insert(vector, -count)
+            pure.extend(j for j in self._hash(vector)[0] if self._pure(j))
+        success = not any(self.counts) and not any(self.keys) and not any(self.checks)
+        return positive, negative, success
+
+    def to_bytes(self):
+        b = [self.salt, struct.pack('>L', self.cells)]
+        for count, key, check in zip(self.counts, self.keys, self.checks):
+            b.append(struct.pack('>i', count) + key.to_bytes(32, 'big') + struct.pack('>L', check))
+        return b''.join(b)
+
+    @classmethod
+    def from_bytes(cls, b):
+        salt = b[:8]
+        cells = struct.unpack('>L', b[8:12])[0]
+        if cells > MAX_CELLS or cells % HASH_COUNT:
+            raise ValueError('malformed IBLT, wrong number of cells: {}'.format(cells))
+        if len(b) != 12 + cells * CELL_SIZE:
+            raise ValueError('malformed IBLT, wrong length')
+        t = cls(cells, salt)
+        for i in range(cells):
+            count, key, check = struct.unpack('>i32sL', b[12 + i * CELL_SIZE:12 + (i + 1) * CELL_SIZE])
+            t.counts[i] = count
+            t.keys[i] = int.from_bytes(key, 'big')
+            t.checks[i] = check
+        return t
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import collections
+import ipaddress
+import logging
+import threading
+import time
+
+
+def normal_host(host):
+    """IPv4 addresses mapped to IPv6 as plain IPv4 ones"""
+    try:
+        ip = ipaddress.ip_address(host.split('%')[0])
+    except (ValueError, AttributeError):
+        return host
+    if ip.version == 6 and ip.ipv4_mapped:
+        return str(ip.ipv4_mapped)
+    return host
+
+
+def subnet(host):
+    """/24 for IPv4 and /48 for IPv6 addresses, host names are their own subnets"""
+    try:
+        ip = ipaddress.ip_address(host.split('%')[0])
+    except ValueError:
+        return host
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ipaddress.ip_network((ip, 24 if ip.version == 4 else 48), strict=False)
+
+
+class ConnectionRegistry(object):
+    """
+    Set of connections indexed by host, subnet, status and network.
+    Connections report status changes with set_status(), listeners
+    are called with (connection, old_status, new_status), old_status
+    is None for added connections and new_status is None for removed ones.
+    """
+    def __init__(self, lock=None):
+        self.lock = lock or threading.RLock()
+        self.connections = set()
+        self.hosts = collections.defaultdict(set)
+        self.subnets = collections.defaultdict(set)
+        self.statuses = collections.defaultdict(set)
+        self.networks = collections.defaultdict(set)
+        self.outgoing = set()
+        self.listeners = []
+        # Banned hosts and times their bans expire
+        self.banned = {}
+
+    def __repr__(self):
+        return 'connection_registry, connections: {}, outgoing: {}'.format(len(self.connections), len(self.outgoing))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, c):
+        return c in self.connections
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def copy(self):
+        with self.lock:
+            return self.connections.copy()
+
+    @staticmethod
+    def _remove_from(index, key, c):
+        s = index.get(key)
+        if s is not None:
+            s.discard(c)
+            if not s:
+                del index[key]
+
+    def add(self, c):
+        with self.lock:
+            if c in self.connections:
+                return
+            self.connections.add(c)
+            self.hosts[c.host].add(c)
+            if c.network == 'ip':
+                self.subnets[subnet(c.host)].add(c)
+            self.statuses[c.status].add(c)
+            self.networks[c.network].add(c)
+            if not c.server:
+                self.outgoing.add(c)
+        self._notify(c, None, c.status)
+
+    def remove(self, c):
+        with self.lock:
+            if c not in self.connections:
+                return
+            self.connections.remove(c)
+            self._remove_from(self.hosts, c.host, c)
+            if c.network == 'ip':
+                self._remove_from(self.subnets, subnet(c.host), c)
+            self._remove_from(self.statuses, c.status, c)
+            self._remove_from(self.networks, c.network, c)
+            self.outgoing.discard(c)
+        self._notify(c, c.status, None)
+
+    def set_status(self, c, status):
+        with self.lock:
+            old_status = c._status
+            if old_status == status:
+                return
+            c._status = status
+            if c not in self.connections:
+                return
+            self._remove_from(self.statuses, old_status, c)
+            self.statuses[status].add(c)
+        self._notify(c, old_status, status)
+
+    def _notify(self, c, old_status, new_status):
+        for listener in self.listeners:
+            try:
+                listener(c, old_status, new_status)
+            except Exception:
+                logging.exception('Exception in connection registry listener')
+
+    def has_host(self, host):
+        return host in self.hosts
+
+    def count_host(self, host):
+        with self.lock:
+            return len(self.hosts.get(host, ()))
+
+    def count_subnet(self, host):
+        with self.lock:
+            return len(self.subnets.get(subnet(host), ()))
+
+    def ban(self, host, seconds):
+        """Returns connections to the host, the caller disconnects them"""
+        host = normal_host(host)
+        with self.lock:
+            self.banned[host] = time.time() + seconds
+            return [c for c in self.connections if normal_host(c.host) == host]
+
+    def unban(self, host):
+        with self.lock:
+            return self.banned.pop(normal_host(host), None) is not None
+
+    def is_banned(self, host):
+        if not self.banned:
+            return False
+        host = normal_host(host)
+        until = self.banned.get(host)
+        if until is None:
+            return False
+        if until < time.time():
+            self.unban(host)
+            return False
+        return True
+
+    def count_outgoing(self):
+        return len(self.outgoing)
+
+    def select(self, status=None, network=None, server=None):
+        """Connections matching all the given criteria"""
+        with self.lock:
+            candidates = [self.connections]
+            if status is not None:
+                candidates.append(self.statuses.get(status, set()))
+            if network is not None:
+                candidates.append(self.networks.get(network, set()))
+            if server is False:
+                candidates.append(self.outgoing)
+            smallest = min(candidates, key=len)
+            return [c for c in smallest
+                    if (status is None or c.status == status)
+                    and (network is None or c.network == network)
+                    and (server is None or c.server == server)]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Replays captured traffic (see capture.py) through Connection message
+processing: parsing, validation and storage of objects.
+
+    python3 replay.py [--speed 10] [--data-dir DIR] FILE...
+
+Captures of several connections are replayed together in order of
+receive times. With --speed 0 messages are processed as fast as possible.
+"""
+import argparse
+import collections
+import heapq
+import json
+import logging
+import time
+
+from benchmark import compare
+import capture
+from connection import Connection
+import main as minode_main
+import shared
+
+
+def _stub(metadata):
+    c = Connection(metadata['host'], metadata['port'], None, metadata['network'], metadata['server'])
+    # Processed messages are never sent
+    c.status = 'fully_established'
+    return c
+
+
+def _drain(q):
+    """Empties a queue, returns the number of items"""
+    n = 0
+    while not q.empty():
+        q.get_nowait()
+        n += 1
+    return n
+
+
+def replay(paths, speed):
+    streams = []
+    for i, path in enumerate(paths):
+        metadata, records = capture.read_capture(path)
+        c = _stub(metadata)
+        streams.append(((t, i, data, c) for t, data in records))
+
+    objects_before = len(shared.objects)
+    commands = collections.Counter()
+    messages = 0
+    replies = 0
+    size = 0
+    max_lag = 0
+    first = None
+    start = time.perf_counter()
+    for t, _, data, c in heapq.merge(*streams, key=lambda record: (record[0], record[1])):
+        if first is None:
+            first = t
+        if speed:
+            delay = (t - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        c.buffer_receive += data
+        c._process_buffer_receive()
+        commands[data[4:16].rstrip(b'\x00').decode(errors='replace')] += 1
+        messages += 1
+        size += len(data)
+        while not c.send_queue.empty():
+            c.send_queue.get()
+            replies += 1
+        _drain(shared.vector_advertise_queue)
+        _drain(shared.address_advertise_queue)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'name': 'replay',
+        'captures': len(paths),
+        'messages': messages,
+        'bytes': size,
+        'seconds': round(elapsed, 3),
+        'ops_per_second': round(messages / elapsed, 1) if elapsed else None,
+        'bytes_per_second': round(size / elapsed) if elapsed else None,
+        'max_lag': round(max_lag, 3),
+        'replies': replies,
+        'objects_stored': len(shared.objects) - objects_before,
+        'commands': dict(commands),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured MiNode traffic')
+    parser.add_argument('files', help='Capture files', nargs='+', metavar='FILE')
+    parser.add_argument('--speed', help='Speed relative to the recorded one, 0 for as fast as possible', type=float, default=0)
+    parser.add_argument('--data-dir', help='Load objects from this data directory first')
+    parser.add_argument('--debug', help='Log processed messages', action='store_true')
+    parser.add_argument('--save', help='Save results to a file', metavar='FILE')
+    parser.add_argument('--baseline', help='Compare with results saved earlier', metavar='FILE')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] [%(levelname)s] %(message)s')
+    else:
+        logging.disable(logging.CRITICAL)
+    if args.data_dir:
+        shared.data_directory = args.data_dir.rstrip('/') + '/'
+        minode_main.load_data()
+
+    results = [replay(args.files, args.speed)]
+    if args.baseline:
+        with open(args.baseline) as file:
+            results = compare(results, json.load(file))
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
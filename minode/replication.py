@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Replication of the object store from a primary node to followers.
+
+The primary keeps an in-memory log of added and deleted objects. Entries
+have consecutive offsets within an epoch, a random id chosen at start.
+A follower connects over TCP, both sides prove they know the shared key
+and the follower asks for the log from its last offset. If the epoch
+changed or the offset is no longer in the log, the primary sends all its
+objects first. Every frame carries a HMAC with a sequence number.
+
+Followers store replicated objects without checking PoW and do not
+request objects from their peers, they only serve them.
+"""
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+import shared
+import structure
+
+MAGIC = b'MiNode replica\x00\x01'
+NONCE_SIZE = 16
+MAC_SIZE = 16
+MAX_FRAME = 2 ** 20
+OFFSET = struct.Struct('>Q')
+
+# Frame types
+ADD = b'a'
+DELETE = b'd'
+RESUME = b'r'
+SNAPSHOT = b's'
+SNAPSHOT_OBJECT = b'o'
+SNAPSHOT_END = b'e'
+HEARTBEAT = b'h'
+
+
+def parse_address(address, default_port):
+    """(host, port) from host, host:port or [IPv6]:port"""
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']:')
+    elif address.count(':') == 1:
+        host, _, port = address.partition(':')
+    else:
+        host, port = address, None
+    return host, int(port) if port else default_port
+
+
+def load_key():
+    """Shared secret of a primary and its followers, created on first use"""
+    path = shared.replication_key_file or shared.data_directory + 'replication.key'
+    if not os.path.exists(path):
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), mode='w') as file:
+            file.write(os.urandom(32).hex())
+        logging.info('Created replication key {}, copy it to followers'.format(path))
+    with open(path) as file:
+        return bytes.fromhex(file.read().strip())
+
+
+def _receive_exactly(s, size):
+    data = b''
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+class Channel(object):
+    """Authenticated frames over a socket: length, payload and HMAC of sequence number and payload"""
+    def __init__(self, s, key):
+        self.s = s
+        self.key = key
+        self.sent = 0
+        self.received = 0
+
+    def _mac(self, sequence, payload):
+        return hmac.new(self.key, OFFSET.pack(sequence) + payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def send(self, payload):
+        self.s.sendall(struct.pack('>L', len(payload)) + payload + self._mac(self.sent, payload))
+        self.sent += 1
+
+    def receive(self):
+        length, = struct.unpack('>L', _receive_exactly(self.s, 4))
+        if length > MAX_FRAME:
+            raise ValueError('frame too long')
+        payload = _receive_exactly(self.s, length)
+        if not hmac.compare_digest(_receive_exactly(self.s, MAC_SIZE), self._mac(self.received, payload)):
+            raise ValueError('wrong frame MAC')
+        self.received += 1
+        return payload
+
+
+def _proof(key, role, first, second):
+    return hmac.new(key, role + first + second, hashlib.sha256).digest()
+
+
+def _session_key(key, primary_nonce, follower_nonce):
+    return hmac.new(key, b'session' + primary_nonce + follower_nonce, hashlib.sha256).digest()
+
+
+class ReplicationLog(object):
+    """Recent changes of the object store, oldest ones are dropped beyond replication_log_size bytes"""
+    def __init__(self):
+        self.epoch = os.urandom(8)
+        self.entries = []
+        self.first_offset = 0
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return 'replication_log, offsets: {}-{}, bytes: {}'.format(self.first_offset, self.next_offset, self.size)
+
+    @property
+    def next_offset(self):
+        return self.first_offset + len(self.entries)
+
+    def _append(self, kind, data):
+        with self.condition:
+            self.entries.append(kind + OFFSET.pack(self.next_offset) + data)
+            self.size += len(data)
+            if self.size > shared.replication_log_size:
+                # Dropped in batches, so that the list is not moved for every entry
+                drop = max(len(self.entries) // 4, 1)
+                self.size -= sum(len(e) - 9 for e in self.entries[:drop])
+                del self.entries[:drop]
+                self.first_offset += drop
+            self.condition.notify_all()
+
+    def on_add(self, obj):
+        self._append(ADD, obj.to_bytes())
+
+    def on_delete(self, vector, obj):
+        self._append(DELETE, vector)
+
+    def read(self, offset, count):
+        """Up to count entries from offset, None if they are no longer kept"""
+        with self.condition:
+            if offset < self.first_offset:
+                return None
+            i = offset - self.first_offset
+            return self.entries[i:i + count]
+
+    def wait(self, offset, timeout):
+        with self.condition:
+            if offset >= self.next_offset:
+                self.condition.wait(timeout)
+
+
+class ReplicationServer(threading.Thread):
+    """Serves the replication log to followers"""
+    def __init__(self, host, port, key):
+        super().__init__(name='Replication server')
+        self.key = key
+        self.log = ReplicationLog()
+        self.s = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.s.bind((host, port))
+        self.s.listen(16)
+        self.s.settimeout(1)
+        shared.objects.listeners.append(self.log.on_add)
+        shared.objects.delete_listeners.append(self.log.on_delete)
+
+    def run(self):
+        while not shared.shutting_down:
+            try:
+                conn, addr = self.s.accept()
+            except socket.timeout:
+                continue
+            logging.info('Replication follower connected from {}:{}'.format(addr[0], addr[1]))
+            ReplicationSession(conn, addr, self.key, self.log).start()
+        self.s.close()
+        logging.debug('Shutting down Replication server')
+
+
+class ReplicationSession(threading.Thread):
+    def __init__(self, s, addr, key, log):
+        super().__init__(name='Replication to {}:{}'.format(addr[0], addr[1]), daemon=True)
+        self.s = s
+        self.addr = addr
+        self.key = key
+        self.log = log
+
+    def run(self):
+        try:
+            channel, epoch, offset = self._handshake()
+            self._stream(channel, epoch, offset)
+        except (OSError, ValueError) as e:
+            logging.info('Replication follower {}:{} disconnected: {}'.format(self.addr[0], self.addr[1], e))
+        finally:
+            self.s.close()
+
+    def _handshake(self):
+        self.s.settimeout(30)
+        nonce = os.urandom(NONCE_SIZE)
+        self.s.sendall(MAGIC + nonce)
+        data = _receive_exactly(self.s, NONCE_SIZE + 32 + 8 + 8)
+        follower_nonce, proof, epoch, offset = data[:16], data[16:48], data[48:56], OFFSET.unpack(data[56:])[0]
+        if not hmac.compare_digest(proof, _proof(self.key, b'follower', nonce, follower_nonce)):
+            raise ValueError('wrong key')
+        self.s.sendall(_proof(self.key, b'primary', follower_nonce, nonce))
+        return Channel(self.s, _session_key(self.key, nonce, follower_nonce)), epoch, offset
+
+    def _stream(self, channel, epoch, offset):
+        if epoch != self.log.epoch or self.log.read(offset, 0) is None:
+            offset = self._snapshot(channel)
+        else:
+            channel.send(RESUME + OFFSET.pack(offset))
+        last_sent = time.time()
+        while not shared.shutting_down:
+            entries = self.log.read(offset, 1000)
+            if entries is None:
+                logging.info('Replication follower {}:{} fell behind the log'.format(self.addr[0], self.addr[1]))
+                offset = self._snapshot(channel)
+                continue
+            for entry in entries:
+                channel.send(entry)
+            offset += len(entries)
+            if entries:
+                last_sent = time.time()
+            elif time.time() - last_sent > shared.replication_heartbeat:
+                channel.send(HEARTBEAT + OFFSET.pack(offset))
+                last_sent = time.time()
+            else:
+                self.log.wait(offset, shared.replication_heartbeat)
+
+    def _snapshot(self, channel):
+        """Sends all objects, returns offset of the log to continue from"""
+        with self.log.condition:
+            offset = self.log.next_offset
+        channel.send(SNAPSHOT + self.log.epoch)
+        count = 0
+        for vector in list(shared.objects.keys()):
+            obj = shared.objects.get(vector)
+            if obj is not None:
+                channel.send(SNAPSHOT_OBJECT + obj.to_bytes())
+                count += 1
+        channel.send(SNAPSHOT_END + OFFSET.pack(offset))
+        logging.info('Sent {} objects to replication follower {}:{}'.format(count, self.addr[0], self.addr[1]))
+        return offset
+
+
+class ReplicationFollower(threading.Thread):
+    """Keeps the object store in sync with a primary, reconnecting when the connection breaks"""
+    def __init__(self, host, port, key):
+        super().__init__(name='Replication follower')
+        self.host = host
+        self.port = port
+        self.key = key
+        self.epoch = bytes(8)
+        self.offset = 0
+        self.applied = collections.Counter()
+        # Vectors received in the snapshot being applied, None outside of a snapshot
+        self.snapshot_vectors = None
+
+    def run(self):
+        delay = 1
+        while not shared.shutting_down:
+            try:
+                s = socket.create_connection((self.host, self.port), 10)
+            except OSError as e:
+                logging.warning('Could not connect to replication primary {}:{}: {}'.format(self.host, self.port, e))
+            else:
+                try:
+                    self._follow(s)
+                    delay = 1
+                except (OSError, ValueError) as e:
+                    if not shared.shutting_down:
+                        logging.warning('Replication from {}:{} interrupted: {}'.format(self.host, self.port, e))
+                finally:
+                    s.close()
+            shared.shutdown_event.wait(delay)
+            delay = min(delay * 2, 60)
+        logging.debug('Shutting down Replication follower')
+
+    def _follow(self, s):
+        s.settimeout(3 * shared.replication_heartbeat)
+        data = _receive_exactly(s, len(MAGIC) + NONCE_SIZE)
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a replication primary')
+        primary_nonce = data[len(MAGIC):]
+        nonce = os.urandom(NONCE_SIZE)
+        s.sendall(nonce + _proof(self.key, b'follower', primary_nonce, nonce) + self.epoch + OFFSET.pack(self.offset))
+        if not hmac.compare_digest(_receive_exactly(s, 32), _proof(self.key, b'primary', nonce, primary_nonce)):
+            raise ValueError('wrong key')
+        channel = Channel(s, _session_key(self.key, primary_nonce, nonce))
+        logging.info('Replicating from {}:{}'.format(self.host, self.port))
+        while not shared.shutting_down:
+            self._apply(channel.receive())
+
+    def _apply(self, frame):
+        kind, data = frame[:1], frame[1:]
+        try:
+            self._apply_frame(kind, data)
+        except (IndexError, struct.error) as e:
+            raise ValueError('malformed frame of type {}: {}'.format(kind, e))
+        self.applied[kind] += 1
+
+    def _apply_frame(self, kind, data):
+        if kind in (ADD, DELETE):
+            offset, = OFFSET.unpack(data[:8])
+            if offset != self.offset:
+                raise ValueError('expected offset {}, got {}'.format(self.offset, offset))
+            if kind == ADD:
+                self._store_object(structure.Object.from_bytes(data[8:]))
+            else:
+                self._remove_object(data[8:])
+            self.offset += 1
+        elif kind == SNAPSHOT_OBJECT:
+            obj = structure.Object.from_bytes(data)
+            if self.snapshot_vectors is not None:
+                self.snapshot_vectors.add(obj.vector)
+            self._store_object(obj)
+        elif kind == SNAPSHOT:
+            if len(data) != 8:
+                raise ValueError('wrong epoch length')
+            logging.info('Receiving all objects from replication primary')
+            self.epoch = data
+            self.snapshot_vectors = set()
+        elif kind == SNAPSHOT_END or kind == RESUME:
+            self.offset, = OFFSET.unpack(data)
+            if kind == SNAPSHOT_END and self.snapshot_vectors is not None:
+                self._remove_missing(self.snapshot_vectors)
+            self.snapshot_vectors = None
+            logging.info('Following replication log from offset {}'.format(self.offset))
+        elif kind != HEARTBEAT:
+            raise ValueError('unknown frame type {}'.format(kind))
+
+    def _remove_missing(self, vectors):
+        """Removes objects the primary deleted while we were not following its log"""
+        missing = [vector for vector in shared.objects.keys() if vector not in vectors]
+        for vector in missing:
+            self._remove_object(vector)
+        if missing:
+            logging.info('Removed {} objects not in the snapshot of replication primary'.format(len(missing)))
+
+    @staticmethod
+    def _store_object(obj):
+        """Objects from the primary are valid, only their expiration is checked"""
+        if obj.vector in shared.objects or obj.is_expired():
+            return
+        with shared.objects_lock:
+            shared.objects[obj.vector] = obj
+        try:
+            shared.vector_advertise_queue.put_nowait(obj.vector)
+        except queue.Full:
+            logging.warning('Vector advertise queue is full, not advertising {}'.format(obj))
+
+    @staticmethod
+    def _remove_object(vector):
+        with shared.objects_lock:
+            obj = shared.objects.pop(vector, None)
+        if obj is not None:
+            shared.tombstones.add(vector, len(obj.to_bytes()))
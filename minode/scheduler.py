@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import random
+import threading
+import time
+
+
+class Histogram(object):
+    """Counts of values in seconds falling under each bound"""
+    bounds = (0.001, 0.01, 0.1, 1, 10, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __repr__(self):
+        buckets = ', '.join('<={}: {}'.format(b, c) for b, c in zip(self.bounds, self.counts) if c)
+        if self.counts[-1]:
+            buckets += ', >{}: {}'.format(self.bounds[-1], self.counts[-1])
+        return 'count: {}, mean: {:.4f}, max: {:.4f}, {{{}}}'.format(
+            self.count, self.total / max(self.count, 1), self.max, buckets)
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        d = {'count': self.count, 'mean': self.total / max(self.count, 1), 'max': self.max}
+        d.update(('le_{}'.format(b), c) for b, c in zip(self.bounds, self.counts))
+        d['gt_{}'.format(self.bounds[-1])] = self.counts[-1]
+        return d
+
+
+class Job(object):
+    def __init__(self, name, function, interval, jitter, heavy, delay):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.heavy = heavy
+        self.next_run = time.monotonic() + (self._next_interval() if delay is None else delay)
+        self.running = False
+        self.skipped = 0
+        self.durations = Histogram()
+        # How late the job started
+        self.overruns = Histogram()
+
+    def __repr__(self):
+        return 'job {}, interval: {}, heavy: {}, skipped: {}, durations: {}, overruns: {}'.format(
+            self.name, self.current_interval(), self.heavy, self.skipped, self.durations, self.overruns)
+
+    def current_interval(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+    def _next_interval(self):
+        return self.current_interval() * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def reschedule(self, now):
+        self.next_run = now + self._next_interval()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.function()
+        except Exception:
+            logging.exception('Exception in maintenance job {}'.format(self.name))
+        finally:
+            self.durations.add(time.monotonic() - start)
+            self.running = False
+
+
+class Scheduler(object):
+    """
+    Runs jobs periodically. Light jobs run on the thread calling run(),
+    heavy ones on a separate worker thread so they don't delay the others.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.jobs = []
+        self.heavy_queue = queue.Queue()
+        self.worker = None
+        # Set by run_soon() to stop waiting for the earliest job
+        self.wakeup = threading.Event()
+
+    def add(self, name, function, interval, jitter=0.1, heavy=False, delay=None):
+        """`interval` in seconds may be a callable, `delay` is the time until the first run"""
+        self.jobs.append(Job(name, function, interval, jitter, heavy, delay))
+
+    def run_soon(self, name):
+        """Runs the job on the next check of pending jobs"""
+        for job in self.jobs:
+            if job.name == name:
+                job.next_run = time.monotonic()
+                self.wakeup.set()
+                return
+        raise KeyError(name)
+
+    def run(self, stop):
+        """Runs jobs until the `stop` event is set"""
+        if any(job.heavy for job in self.jobs):
+            self.worker = threading.Thread(target=self._run_heavy, name=self.name + ' worker')
+            self.worker.start()
+        while not stop.is_set():
+            self.wakeup.clear()
+            self.run_pending()
+            # Waits for the earliest job or run_soon(), `stop` is checked at least every second
+            self.wakeup.wait(min(max(min(job.next_run for job in self.jobs) - time.monotonic(), 0), 1))
+        self.heavy_queue.put(None)
+
+    def run_pending(self):
+        now = time.monotonic()
+        for job in self.jobs:
+            if job.next_run > now:
+                continue
+            job.overruns.add(now - job.next_run)
+            job.reschedule(now)
+            if job.running:
+                # The previous run has not finished yet
+                job.skipped += 1
+                continue
+            job.running = True
+            if job.heavy:
+                self.heavy_queue.put(job)
+            else:
+                job.run()
+                now = time.monotonic()
+
+    def _run_heavy(self):
+        while True:
+            job = self.heavy_queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def stats(self):
+        return {job.name: {'interval': job.current_interval(),
+                           'skipped': job.skipped,
+                           'durations': job.durations.to_dict(),
+                           'overruns': job.overruns.to_dict()}
+                for job in self.jobs}
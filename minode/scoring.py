@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+
+import shared
+
+
+def score(c):
+    """Usefulness of a fully established connection, higher is better"""
+    hours = max(time.time() - c.established_time, 60) / 3600
+    bytes_per_object = c.bytes_received / max(c.objects_new, 1)
+    s = 10 * math.log1p(c.objects_new / hours)  # objects they delivered first
+    s -= min(c.request_window.srtt or 0, 60) / 6
+    s -= min(c.handshake_time, 30) / 3
+    s -= math.log2(1 + bytes_per_object / 10000)
+    return s
+
+
+def record(c):
+    """Remembers score of a connection for its address, averaged with previous ones"""
+    if c.established_time is None:
+        return
+    addr = (c.host, c.port)
+    new = score(c)
+    old = shared.node_scores.get(addr)
+    shared.node_scores[addr] = new if old is None else 0.7 * old + 0.3 * new
+
+
+def best(addresses, count):
+    """count addresses with the best scores, unknown ones are in the middle"""
+    return sorted(addresses, key=lambda a: shared.node_scores.get(a, 0), reverse=True)[:count]
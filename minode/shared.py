@@ -4,6 +4,11 @@ import os
 import queue
 import threading
 
+import bloom
+import inventory
+import locks
+import registry
+
 listening_port = 8444
 listening_host = ''
 send_outgoing_connections = True
@@ -17,7 +22,8 @@ log_level = logging.INFO
 
 magic_bytes = b'\xe9\xbe\xb4\xd9'
 protocol_version = 3
-services = 3  # NODE_NETWORK, NODE_SSL
+service_reconciliation = 1 << 40  # MiNode extension, see reconciliation.py
+services = 3 | service_reconciliation  # NODE_NETWORK, NODE_SSL, reconciliation
 stream = 1
 nonce = os.urandom(8)
 user_agent = b'/MiNode:0.3.0/'
@@ -38,28 +44,128 @@ nonce_trials_per_byte = 1000
 payload_length_extra_bytes = 1000
 
 shutting_down = False
+shutdown_event = threading.Event()
 
-vector_advertise_queue = queue.Queue()
-address_advertise_queue = queue.Queue()
+vector_advertise_queue = queue.Queue(maxsize=100000)
+address_advertise_queue = queue.Queue(maxsize=10000)
 
-connections = set()
-connections_lock = threading.Lock()
+connections = registry.ConnectionRegistry(locks.InstrumentedLock('connections_lock', reentrant=True))
 
 i2p_dialers = set()
 
-hosts = set()
-
 core_nodes = set()
 
 node_pool = set()
 unchecked_node_pool = set()
 
+# Scores of nodes we were connected to, see scoring.py
+node_scores = {}
+
 i2p_core_nodes = set()
 i2p_node_pool = set()
 i2p_unchecked_node_pool = set()
 
 outgoing_connections = 8
 connection_limit = 250
+# Incoming connections
+listen_backlog = 512
+accept_rate = 20  # per second
+max_connections_per_ip = 4
+max_connections_per_subnet = 16
+# Outgoing peers saved at shutdown, dialed first on start, see bootstrap.py
+warm_peers = ()
+# DNS bootstrap runs if less than a half of warm peers connected in this many seconds
+warm_start_timeout = 20
+# The worst outgoing connection older than rotation_min_age is replaced every rotation_interval seconds
+rotation_interval = 600
+rotation_min_age = 600
+
+# Bandwidth limits in bytes per second, 0 means unlimited
+upload_limit = 0
+download_limit = 0
+peer_upload_limit = 0
+peer_download_limit = 0
+# Messages are moved from send_queue to the socket buffer only while it holds less than this
+send_buffer_size = 65536
+
+# Objects requested from a peer and not received yet, see window.py
+request_window_initial = 100
+request_window_min = 8
+request_window_max = 5000
+max_getdata_batch = 1000
+# Seconds after which requested objects are requested again
+request_timeout_min = 10
+request_timeout_max = 600
+
+# Entries per inv message sent to new connections
+inv_chunk_size = 10000
+
+# Longest sleep of connection loops and interval of advertising new objects and addresses, in seconds
+select_timeout = 0.2
+advertise_interval = 0.4
+# Interval of checking requested objects for timeouts and vectors to get for known objects, in seconds
+request_check_interval = 1
+
+# Initial number of cells of inventory sketches sent to MiNode peers
+sketch_cells = 600
+
+# Admission control, see admission.py
+admission_control = True
+# The node is overloaded when its loop lag in seconds or share of time spent validating objects is above these
+overload_lag = 0.1
+overload_validation_load = 0.7
+# Objects requested at a time from a connection while overloaded
+overload_getdata_batch = 8
+# Inventory from peers with fewer new objects among those received is put aside while overloaded
+min_useful_ratio = 0.05
+
+# Encoded object messages kept for sending to many peers, in bytes
+framed_cache_size = 32 * 1024 * 1024
+
+# Requested objects are queued for a connection while less than this many bytes wait to be sent to it
+send_budget = 1024 * 1024
+
+# Memory limits in bytes
+memory_limit = 512 * 1024 * 1024
+# We stop reading from a connection and serving objects to it when this much data waits to be sent
+send_backlog_limit = 4 * 1024 * 1024
+max_vectors_to_get = 100000
+max_vectors_to_send = 50000
+memory_pressure = False
+# Vectors of invalid and expired objects, so that we don't download them again
+tombstone_capacity = 200000
+tombstone_period = 6 * 3600
+
+objects = inventory.Inventory()
+objects_lock = locks.InstrumentedLock('objects_lock')
+tombstones = bloom.RollingBloomFilter(tombstone_capacity, tombstone_period)
+
+api_enabled = False
+admin_enabled = False
+
+# Sampling profiler, see profiler.py
+profile_duration = 30
+profile_interval = 0.01
+
+# Object tracing, see tracer.py
+trace_enabled = False
+trace_sample_rate = 0.01
+
+# Capture of received messages, see capture.py
+capture_directory = None
+
+# Replication, see replication.py
+replication_listen = None
+replicate_from = None
+replication_key_file = None
+replication_log_size = 64 * 1024 * 1024
+replication_heartbeat = 5
+
+# Object snapshot commands, see snapshot.py
+export_objects_file = None
+import_objects_file = None
 
-objects = {}
-objects_lock = threading.Lock()
+# Multi-process mode, see workers.py
+workers = 1
+worker_id = None
+worker_queue = None
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Object store snapshots.
+
+A snapshot starts with MAGIC, followed by objects, each prefixed with its
+length as a 4-byte big-endian integer. A zero length ends the objects and
+is followed by the number of objects (8 bytes) and a SHA-256 digest of
+everything between MAGIC and the zero length.
+
+PyBitmessage messages.dat files are read too, objects are taken from
+their inventory table.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import struct
+import time
+
+import shared
+import structure
+
+MAGIC = b'MiNode objects\x00\x01'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+BATCH_SIZE = 10000
+
+
+def export_objects(path):
+    """Writes unexpired objects to a snapshot file, returns their number"""
+    with shared.objects_lock:
+        objects = [obj for obj in shared.objects.values() if obj.expires_time > time.time()]
+    h = hashlib.sha256()
+    with open(path + '.tmp', mode='bw') as file:
+        file.write(MAGIC)
+        for obj in objects:
+            b = obj.to_bytes()
+            record = struct.pack('>L', len(b)) + b
+            h.update(record)
+            file.write(record)
+        file.write(struct.pack('>LQ', 0, len(objects)) + h.digest())
+    os.replace(path + '.tmp', path)
+    return len(objects)
+
+
+def _read_snapshot(file):
+    h = hashlib.sha256()
+    count = 0
+    while True:
+        header = file.read(4)
+        if len(header) < 4:
+            raise ValueError('Snapshot is truncated')
+        length, = struct.unpack('>L', header)
+        if length == 0:
+            break
+        b = file.read(length)
+        if len(b) < length:
+            raise ValueError('Snapshot is truncated')
+        h.update(header + b)
+        count += 1
+        yield b
+    trailer = file.read(40)
+    if len(trailer) < 40:
+        raise ValueError('Snapshot is truncated')
+    expected_count, digest = struct.unpack('>Q32s', trailer)
+    if expected_count != count or digest != h.digest():
+        raise ValueError('Snapshot checksum mismatch')
+
+
+def _read_pybitmessage(path):
+    connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        for payload, in connection.execute(
+                'SELECT payload FROM inventory WHERE expirestime > ? AND streamnumber = 1', (int(time.time()),)):
+            yield bytes(payload)
+    finally:
+        connection.close()
+
+
+def read_objects(path):
+    """Yields object payloads from a snapshot or a PyBitmessage messages.dat file"""
+    with open(path, mode='br') as file:
+        magic = file.read(len(SQLITE_MAGIC))
+        if magic == SQLITE_MAGIC:
+            file.close()
+            yield from _read_pybitmessage(path)
+            return
+        file.seek(0)
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a MiNode snapshot or PyBitmessage messages.dat file')
+        yield from _read_snapshot(file)
+
+
+def _check(payload):
+    """Returns vector of a valid object, runs in pool processes"""
+    try:
+        obj = structure.Object.from_bytes(payload)
+    except Exception:
+        return None
+    return obj.vector if obj.is_valid() else None
+
+
+def _batches(iterable):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_objects(path, processes=None):
+    """
+    Adds valid objects from a file to the object store, PoW is checked
+    by a pool of processes. Nothing is added if a snapshot is damaged.
+    Returns counts of imported, invalid and duplicate objects.
+    """
+    counts = {'imported': 0, 'invalid': 0, 'duplicate': 0}
+    valid = []
+    with multiprocessing.Pool(processes) as pool:
+        for batch in _batches(read_objects(path)):
+            for payload, vector in zip(batch, pool.map(_check, batch, chunksize=256)):
+                if vector is None:
+                    counts['invalid'] += 1
+                else:
+                    valid.append((vector, payload))
+    for vector, payload in valid:
+        if vector in shared.objects:
+            counts['duplicate'] += 1
+            continue
+        with shared.objects_lock:
+            shared.objects[vector] = structure.Object.from_bytes(payload, vector)
+        counts['imported'] += 1
+    logging.info('Imported {imported} objects, {invalid} invalid, {duplicate} duplicate'.format(**counts))
+    return counts
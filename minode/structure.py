@@ -44,21 +44,29 @@ class VarInt(object):
 
 
 class Object(object):
-    def __init__(self, nonce, expires_time, object_type, version, stream_number, object_payload):
+    def __init__(self, nonce, expires_time, object_type, version, stream_number, object_payload, vector=None):
         self.nonce = nonce
         self.expires_time = expires_time
         self.object_type = object_type
         self.version = version
         self.stream_number = stream_number
         self.object_payload = object_payload
-        self.vector = hashlib.sha512(hashlib.sha512(self.to_bytes()).digest()).digest()[:32]
+        self.vector = vector or hashlib.sha512(hashlib.sha512(self.to_bytes()).digest()).digest()[:32]
 
     def __repr__(self):
         return 'object, vector: {}'.format(base64.b16encode(self.vector).decode())
 
     @classmethod
     def from_message(cls, m):
-        payload = m.payload
+        # The payload hash is the inner hash of the vector
+        obj = cls.from_bytes(m.payload, hashlib.sha512(m.payload_hash).digest()[:32])
+        # Vector and PoW hash are of the received bytes, objects are served re-encoded
+        if len(obj.to_bytes()) != len(m.payload):
+            raise ValueError('malformed object, non-canonical encoding')
+        return obj
+
+    @classmethod
+    def from_bytes(cls, payload, vector=None):
         nonce, expires_time, object_type = struct.unpack('>8sQL', payload[:20])
         payload = payload[20:]
         version_varint_length = VarInt.length(payload[0])
@@ -67,7 +75,7 @@ class Object(object):
         stream_number_varint_length = VarInt.length(payload[0])
         stream_number = VarInt.from_bytes(payload[:stream_number_varint_length]).n
         payload = payload[stream_number_varint_length:]
-        return cls(nonce, expires_time, object_type, version, stream_number, payload)
+        return cls(nonce, expires_time, object_type, version, stream_number, payload, vector)
 
     def to_bytes(self):
         payload = b''
@@ -80,7 +88,8 @@ class Object(object):
     def is_expired(self):
         return self.expires_time + 3 * 3600 < time.time()
 
-    def is_valid(self):
+    def is_valid(self, initial_hash=None):
+        """`initial_hash` is pow_initial_hash() if already known"""
         if self.is_expired():
             logging.debug('Invalid object {}, reason: expired'.format(base64.b16encode(self.vector).decode()))
             return False
@@ -93,10 +102,7 @@ class Object(object):
         if self.stream_number != 1:
             logging.warning('Invalid object {}, reason: not in stream 1'.format(base64.b16encode(self.vector).decode()))
             return False
-        data = self.to_bytes()[8:]
-        length = len(data) + 8 + shared.payload_length_extra_bytes
-        dt = max(self.expires_time - time.time(), 0)
-        h = hashlib.sha512(data).digest()
+        h = initial_hash or self.pow_initial_hash()
         pow_value = int.from_bytes(hashlib.sha512(hashlib.sha512(self.nonce + h).digest()).digest()[:8], 'big')
         target = self.pow_target()
         if target < pow_value:
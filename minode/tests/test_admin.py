@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import admin
+import shared
+
+
+class TestAdminHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = admin.AdminHandler.__new__(admin.AdminHandler)
+
+    def test_set_min_above_max(self):
+        window_min = shared.request_window_min
+        response = self.handler._handle(
+            '{{"command": "set", "settings": {{"request_window_min": {}}}}}'.format(shared.request_window_max + 1).encode())
+        self.assertEqual(
+            response, {'error': 'ValueError: request_window_min must not be greater than request_window_max'})
+        self.assertEqual(shared.request_window_min, window_min)
+
+    def test_set_both(self):
+        self.addCleanup(setattr, shared, 'request_timeout_min', shared.request_timeout_min)
+        self.addCleanup(setattr, shared, 'request_timeout_max', shared.request_timeout_max)
+        response = self.handler._handle(
+            b'{"command": "set", "settings": {"request_timeout_min": 700, "request_timeout_max": 800}}')
+        self.assertEqual(response, {'settings': {'request_timeout_min': 700.0, 'request_timeout_max': 800.0}})
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import api
+
+
+class TestRequestHandler(unittest.TestCase):
+    def setUp(self):
+        # Requests are handled without a socket
+        self.handler = api.APIHandler.__new__(api.APIHandler)
+
+    def test_not_object(self):
+        for line in (b'[]', b'1', b'"x"', b'null'):
+            self.assertEqual(self.handler._handle(line), {'error': 'request must be a JSON object'})
+
+    def test_malformed(self):
+        self.assertIn('error', self.handler._handle(b'{'))
+        self.assertEqual(self.handler._handle(b'{"command": "nope"}'), {'error': 'unknown command'})
+
+    def test_submit_malformed(self):
+        response = self.handler._handle(b'{"command": "submit", "objects": ["!!!", "YWJj"]}')
+        self.assertEqual(response, {'accepted': [], 'rejected': [0, 1]})
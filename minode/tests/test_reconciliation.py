@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+import reconciliation
+
+
+class TestIBLT(unittest.TestCase):
+    def test_decode(self):
+        ours = [os.urandom(32) for _ in range(100)]
+        theirs = [os.urandom(32) for _ in range(5)]
+        salt = os.urandom(8)
+        a = reconciliation.IBLT.from_vectors(ours[:95] + theirs, 30, salt)
+        b = reconciliation.IBLT.from_vectors(ours, 30, salt)
+        positive, negative, success = a.subtract(b).decode()
+        self.assertTrue(success)
+        self.assertEqual(positive, set(theirs))
+        self.assertEqual(negative, set(ours[95:]))
+
+    def test_decode_crafted(self):
+        """A vector in one of its cells only peels back and forth"""
+        t = reconciliation.IBLT(30, os.urandom(8))
+        vector = os.urandom(32)
+        indices, check = t._hash(vector)
+        t.counts[indices[0]] = 1
+        t.keys[indices[0]] = int.from_bytes(vector, 'big')
+        t.checks[indices[0]] = check
+        t = reconciliation.IBLT.from_bytes(t.to_bytes())
+        _, _, success = t.decode()
+        self.assertFalse(success)
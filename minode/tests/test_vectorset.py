@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+import vectorset
+
+
+class TestVectorSet(unittest.TestCase):
+    def test_set(self):
+        vectors = [os.urandom(32) for _ in range(1000)] + [vectorset.EMPTY, vectorset.DELETED]
+        s = vectorset.VectorSet(vectors)
+        self.assertEqual(len(s), len(vectors))
+        self.assertEqual(set(s), set(vectors))
+        for v in vectors[::2]:
+            s.discard(v)
+        self.assertEqual(set(s), set(vectors[1::2]))
+        self.assertNotIn(vectors[0], s)
+        self.assertIn(vectors[1], s)
+        self.assertEqual(set(s.difference(set(vectors[1:100]))), set(vectors[101::2]))
+        with self.assertRaises(ValueError):
+            s.add(b'short')
+
+
+class TestVectorQueue(unittest.TestCase):
+    def test_queue(self):
+        vectors = [os.urandom(32) for _ in range(3000)]
+        q = vectorset.VectorQueue(vectors + vectors[:10])
+        self.assertEqual(len(q), len(vectors))
+        for v in vectors[:2500]:
+            q.discard(v)
+        self.assertEqual([q.popleft() for _ in range(len(q))], vectors[2500:])
+        with self.assertRaises(IndexError):
+            q.popleft()
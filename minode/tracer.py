@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in tracing of objects through the node, enabled with --trace.
+
+Every object gets a timestamp at each stage it passes. For each stage
+a histogram of time since the closest earlier stage of the same object
+is kept. Traces of a sample of objects are written to trace.log in the
+data directory as JSON lines.
+"""
+import base64
+import collections
+import json
+import logging
+import threading
+import time
+
+from scheduler import Histogram
+import shared
+
+STAGES = (
+    'inv_received', 'getdata_sent', 'object_received', 'validated', 'stored',
+    'advertise_queued', 'inv_sent', 'object_served')
+# Traces are kept for this many seconds after the first stage
+TRACE_AGE = 120
+MAX_TRACES = 100000
+
+
+class Trace(object):
+    def __init__(self, vector, sampled, start):
+        self.vector = vector
+        self.start = start
+        self.first = {}
+        self.events = [] if sampled else None
+
+    def to_json(self):
+        return json.dumps({
+            'vector': base64.b16encode(self.vector).decode(),
+            'start': self.start,
+            'events': [[stage, round(t - self.start, 6), peer] for stage, t, peer in self.events]})
+
+
+class Tracer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = collections.OrderedDict()
+        self.latency = {stage: Histogram() for stage in STAGES}
+        self.since_first = {stage: Histogram() for stage in STAGES}
+        self.finished = []
+
+    def _sampled(self, vector):
+        # Depends only on the vector, so that nodes sample the same objects
+        return vector[0] < 256 * shared.trace_sample_rate
+
+    def record(self, vectors, stage, connection=None):
+        t = time.time()
+        peer = '{}:{}'.format(connection.host_print, connection.port) if connection else None
+        index = STAGES.index(stage)
+        with self.lock:
+            for vector in vectors:
+                trace = self.traces.get(vector)
+                if trace is None:
+                    trace = self.traces[vector] = Trace(vector, self._sampled(vector), t)
+                    if len(self.traces) > MAX_TRACES:
+                        self._finish(self.traces.popitem(last=False)[1])
+                for earlier in reversed(STAGES[:index]):
+                    if earlier in trace.first:
+                        self.latency[stage].add(t - trace.first[earlier])
+                        break
+                self.since_first[stage].add(t - trace.start)
+                trace.first.setdefault(stage, t)
+                if trace.events is not None:
+                    trace.events.append((stage, t, peer))
+
+    def _finish(self, trace):
+        if trace.events is not None:
+            self.finished.append(trace)
+
+    def flush(self, everything=False):
+        """Writes sampled traces older than TRACE_AGE, or all of them, to the trace log"""
+        now = time.time()
+        with self.lock:
+            while self.traces:
+                vector, trace = next(iter(self.traces.items()))
+                if now - trace.start < TRACE_AGE and not everything:
+                    break
+                del self.traces[vector]
+                self._finish(trace)
+            finished, self.finished = self.finished, []
+        if not finished:
+            return
+        try:
+            with open(shared.data_directory + 'trace.log', mode='a') as file:
+                for trace in finished:
+                    file.write(trace.to_json() + '\n')
+        except Exception as e:
+            logging.warning('Error while writing trace log')
+            logging.warning(e)
+
+    def log_stats(self):
+        for stage in STAGES:
+            if self.since_first[stage].count:
+                logging.info('Trace {}: latency: {}, since first stage: {}'.format(
+                    stage, self.latency[stage], self.since_first[stage]))
+
+    def stats(self):
+        return {stage: {'latency': self.latency[stage].to_dict(), 'since_first': self.since_first[stage].to_dict()}
+                for stage in STAGES}
+
+
+tracer = Tracer()
+
+
+def record(vectors, stage, connection=None):
+    """Records vectors at a stage, does nothing unless tracing is enabled"""
+    if shared.trace_enabled:
+        tracer.record(vectors, stage, connection)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Compact containers of 32-byte inventory vectors.
+
+Vectors are stored back to back in a bytearray used as an open addressing
+hash table with linear probing, which takes about a half of memory of
+a set of bytes objects. Probing in Python makes them about ten times slower
+than builtin containers, so they are only used for big sets which are kept
+for long, such as vectors to send.
+"""
+
+VECTOR_SIZE = 32
+# Markers of free and deleted slots, vectors equal to them are kept in a set
+EMPTY = bytes(VECTOR_SIZE)
+DELETED = b'\xff' * VECTOR_SIZE
+MIN_CAPACITY = 8
+# The table is rebuilt with TARGET_LOAD of slots used when live and deleted
+# vectors take more than MAX_LOAD or live ones less than MIN_LOAD of slots
+MAX_LOAD = 0.8
+TARGET_LOAD = 0.55
+MIN_LOAD = 0.1
+
+
+class VectorSet(object):
+    def __init__(self, vectors=()):
+        self._clear(MIN_CAPACITY)
+        for v in vectors:
+            self.add(v)
+
+    def __repr__(self):
+        return 'vector_set, count: {}, capacity: {}'.format(len(self), self.capacity)
+
+    def __len__(self):
+        return self.count + len(self.special)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, vector):
+        if vector == EMPTY or vector == DELETED:
+            return vector in self.special
+        return self._lookup(vector)[1]
+
+    def __iter__(self):
+        # Iterates over a copy so the set can be changed meanwhile
+        table = bytes(self.table)
+        for o in range(0, len(table), VECTOR_SIZE):
+            v = table[o:o + VECTOR_SIZE]
+            if v != EMPTY and v != DELETED:
+                yield v
+        yield from self.special.copy()
+
+    def memory_size(self):
+        return len(self.table) + len(self.special) * 100
+
+    def _clear(self, capacity):
+        self.capacity = capacity
+        self.table = bytearray(capacity * VECTOR_SIZE)
+        # Live vectors in the table
+        self.count = 0
+        # Live and deleted slots
+        self.used = 0
+        self.special = set()
+
+    def _lookup(self, vector):
+        """Returns slot of the vector and True, or a free slot for it and False"""
+        table = self.table
+        capacity = self.capacity
+        i = hash(vector) % capacity
+        free = -1
+        while True:
+            o = i * VECTOR_SIZE
+            v = table[o:o + VECTOR_SIZE]
+            if v == vector:
+                return i, True
+            if v == EMPTY:
+                return (i if free < 0 else free), False
+            if free < 0 and v == DELETED:
+                free = i
+            i += 1
+            if i == capacity:
+                i = 0
+
+    @staticmethod
+    def _capacity_for(count):
+        return max(int(count / TARGET_LOAD) + 1, MIN_CAPACITY)
+
+    def _items(self):
+        """Live (slot, vector) pairs of the table"""
+        table = self.table
+        for i in range(self.capacity):
+            o = i * VECTOR_SIZE
+            v = bytes(table[o:o + VECTOR_SIZE])
+            if v != EMPTY and v != DELETED:
+                yield i, v
+
+    def _resize(self, capacity):
+        vectors = [v for _, v in self._items()]
+        special = self.special
+        self._clear(capacity)
+        self.special = special
+        for v in vectors:
+            self._insert(v)
+
+    def _insert(self, vector):
+        i, found = self._lookup(vector)
+        if not found:
+            o = i * VECTOR_SIZE
+            if self.table[o:o + VECTOR_SIZE] == EMPTY:
+                self.used += 1
+            self.table[o:o + VECTOR_SIZE] = vector
+            self.count += 1
+
+    def add(self, vector):
+        if len(vector) != VECTOR_SIZE:
+            raise ValueError('Vector must be {} bytes long'.format(VECTOR_SIZE))
+        if vector == EMPTY or vector == DELETED:
+            self.special.add(vector)
+            return
+        if self.used + 1 > self.capacity * MAX_LOAD:
+            self._resize(self._capacity_for(self.count + 1))
+        self._insert(vector)
+
+    def _delete(self, i):
+        o = i * VECTOR_SIZE
+        self.table[o:o + VECTOR_SIZE] = DELETED
+        self.count -= 1
+        if self.capacity > MIN_CAPACITY and self.count < self.capacity * MIN_LOAD:
+            self._resize(self._capacity_for(self.count))
+
+    def discard(self, vector):
+        if vector == EMPTY or vector == DELETED:
+            self.special.discard(vector)
+            return
+        i, found = self._lookup(vector)
+        if found:
+            self._delete(i)
+
+    def difference(self, other):
+        """Vectors not in `other`, any container"""
+        return self.__class__(v for v in self if v not in other)
+
+
+class VectorQueue(object):
+    """Vectors in order of addition, without duplicates"""
+    def __init__(self, vectors=()):
+        self.buffer = bytearray()
+        self.head = 0
+        self.members = VectorSet()
+        self.extend(vectors)
+
+    def __repr__(self):
+        return 'vector_queue, count: {}'.format(len(self))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __bool__(self):
+        return len(self.members) > 0
+
+    def __contains__(self, vector):
+        return vector in self.members
+
+    def memory_size(self):
+        return len(self.buffer) + self.members.memory_size()
+
+    def extend(self, vectors):
+        for v in vectors:
+            if v not in self.members:
+                self.members.add(v)
+                self.buffer += v
+
+    def discard(self, vector):
+        """The vector stays in the buffer and is skipped later"""
+        self.members.discard(vector)
+        if len(self.buffer) - self.head > 2 * VECTOR_SIZE * (len(self.members) + 1024):
+            self._compact()
+
+    def popleft(self):
+        while self.head < len(self.buffer):
+            v = bytes(self.buffer[self.head:self.head + VECTOR_SIZE])
+            self.head += VECTOR_SIZE
+            if v in self.members:
+                self.members.discard(v)
+                if self.head > len(self.buffer) // 2:
+                    del self.buffer[:self.head]
+                    self.head = 0
+                return v
+        raise IndexError('pop from an empty vector queue')
+
+    def _compact(self):
+        """Drops discarded vectors from the buffer"""
+        buffer = bytearray()
+        seen = VectorSet()
+        for o in range(self.head, len(self.buffer), VECTOR_SIZE):
+            v = bytes(self.buffer[o:o + VECTOR_SIZE])
+            if v in self.members and v not in seen:
+                seen.add(v)
+                buffer += v
+        self.buffer = buffer
+        self.head = 0
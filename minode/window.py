@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import time
+
+import ratelimit
+import shared
+
+
+class RequestWindow(object):
+    """
+    Limit of objects requested from a peer and not yet received, adjusted like a TCP congestion window.
+    It grows with every object delivered in time and is halved when requests time out.
+    Request timeout follows the measured round trip time from getdata to object.
+    """
+    def __init__(self):
+        self.size = float(shared.request_window_initial)
+        self.threshold = float(shared.request_window_max)
+        self.srtt = None
+        self.rttvar = None
+        self.last_decrease = 0
+        self.delivered = ratelimit.RateMeter()
+
+    def __repr__(self):
+        return 'request_window, size: {}, srtt: {}, rate: {:.2f}'.format(int(self.size), self.srtt, self.delivered.rate())
+
+    def room(self, outstanding):
+        return max(int(self.size) - outstanding, 0)
+
+    def timeout(self):
+        if self.srtt is None:
+            return shared.request_timeout_max
+        return min(max(self.srtt + 4 * self.rttvar, shared.request_timeout_min), shared.request_timeout_max)
+
+    def on_delivery(self, rtt):
+        self.delivered.add()
+
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        if self.size < self.threshold:
+            self.size += 1
+        else:
+            self.size += 1 / self.size
+        self.size = min(self.size, shared.request_window_max)
+
+    def on_timeout(self):
+        now = time.time()
+        # Decrease at most once per round trip, requests of one window time out together
+        if now - self.last_decrease < (self.srtt or 0):
+            return
+        self.last_decrease = now
+        self.threshold = max(self.size / 2, shared.request_window_min)
+        self.size = self.threshold
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import zlib
+
+import inventory
+import ratelimit
+import shared
+import structure
+
+
+def _config():
+    """Settings copied from the coordinator into worker processes, everything simple enough to pickle"""
+    return {k: v for k, v in vars(shared).items()
+            if not k.startswith('_') and isinstance(v, (bool, int, float, str, bytes, tuple, set, type(None)))}
+
+
+def owns(host):
+    """Whether outgoing connections to host are made by this worker"""
+    if shared.worker_id is None:
+        return True
+    return zlib.crc32(str(host).encode()) % shared.workers == shared.worker_id
+
+
+def share_object(obj):
+    """Hands an object accepted by this worker over to the other workers"""
+    if shared.worker_queue:
+        shared.worker_queue.put((shared.worker_id, obj.vector, obj.expires_time, obj.to_bytes()))
+
+
+def run_worker(worker_id, config, objects, inbox, outbox):
+    import main
+
+    for k, v in config.items():
+        setattr(shared, k, v)
+    shared.worker_id = worker_id
+    shared.worker_queue = outbox
+    shared.objects = inventory.Inventory(objects)
+    # Split outgoing connection slots and the connection limit between workers
+    shared.outgoing_connections = shared.outgoing_connections // shared.workers + \
+        (1 if worker_id < shared.outgoing_connections % shared.workers else 0)
+    shared.connection_limit = max(shared.connection_limit // shared.workers, 1)
+    ratelimit.upload.set_rate(shared.upload_limit // shared.workers)
+    ratelimit.download.set_rate(shared.download_limit // shared.workers)
+
+    signal.signal(signal.SIGINT, main.handler)
+    signal.signal(signal.SIGTERM, main.handler)
+
+    logging.basicConfig(level=shared.log_level,
+                        format='[%(asctime)s] [%(levelname)s] [worker {}] %(message)s'.format(worker_id))
+    logging.info('Starting worker {} with {} objects'.format(worker_id, len(shared.objects)))
+
+    link = WorkerLink(inbox)
+    link.start()
+
+    main.start_services()
+
+    while not shared.shutting_down:
+        time.sleep(1)
+
+
+class WorkerLink(threading.Thread):
+    """Stores objects accepted by other workers, they are already validated"""
+    def __init__(self, inbox):
+        super().__init__(name='Worker link')
+        self.inbox = inbox
+
+    def run(self):
+        while not shared.shutting_down:
+            try:
+                payload = self.inbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            obj = structure.Object.from_bytes(payload)
+            if obj.vector in shared.objects:
+                continue
+            with shared.objects_lock:
+                shared.objects[obj.vector] = obj
+            try:
+                shared.vector_advertise_queue.put_nowait(obj.vector)
+            except queue.Full:
+                logging.warning('Vector advertise queue is full, not advertising {}'.format(obj))
+        logging.debug('Shutting down Worker link')
+
+
+class Coordinator(threading.Thread):
+    """Starts worker processes and relays objects accepted by one of them to all others"""
+    def __init__(self):
+        super().__init__(name='Coordinator')
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.processes = []
+        self.seen = {vector: obj.expires_time for vector, obj in shared.objects.items()}
+        self.last_cleaned = time.time()
+
+        config = _config()
+        for i in range(shared.workers):
+            inbox = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_worker, args=(i, config, shared.objects, inbox, self.outbox),
+                                        name='MiNode worker {}'.format(i))
+            self.inboxes.append(inbox)
+            self.processes.append(p)
+
+    def run(self):
+        for p in self.processes:
+            p.start()
+        # Workers hold the objects now, the coordinator only remembers vectors
+        shared.objects = inventory.Inventory()
+        logging.info('Started {} workers'.format(len(self.processes)))
+
+        while not shared.shutting_down:
+            try:
+                worker_id, vector, expires_time, payload = self.outbox.get(timeout=1)
+                if vector not in self.seen:
+                    self.seen[vector] = expires_time
+                    for i, inbox in enumerate(self.inboxes):
+                        if i != worker_id:
+                            inbox.put(payload)
+            except queue.Empty:
+                pass
+            if time.time() - self.last_cleaned > 90:
+                self._clean()
+                self.last_cleaned = time.time()
+
+        logging.debug('Shutting down Coordinator')
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
+
+    def _clean(self):
+        now = time.time()
+        self.seen = {vector: t for vector, t in self.seen.items() if t + 3 * 3600 > now}
+        for i, p in enumerate(self.processes):
+            if not p.is_alive():
+                logging.error('Worker {} exited with code {}'.format(i, p.exitcode))